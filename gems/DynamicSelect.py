@@ -1,13 +1,427 @@
 
 import dataclasses
+import hashlib
 import json
+import math
+import re
 from dataclasses import dataclass
+from typing import List, Optional
 
 from prophecy.cb.sql.Component import *
 from prophecy.cb.sql.MacroBuilderBase import *
 from prophecy.cb.ui.uispec import *
 
 
+class UnsupportedExpression(Exception):
+    """Raised when a customExpression needs the warehouse to be evaluated."""
+
+
+# Tokens of the SQL subset evaluated locally; anything else is left to the warehouse
+_TOKEN_PATTERN = re.compile(r"""
+    \s+
+  | (?P<string>'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")
+  | (?P<quoted>`(?:[^`]|``)+`)
+  | (?P<number>(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][+-]?\d+)?)
+  | (?P<operator><=|>=|<>|!=|==|\|\||[-+*/%=<>(),!])
+  | (?P<word>[A-Za-z_][A-Za-z0-9_]*)
+""", re.VERBOSE)
+
+_METADATA_COLUMNS = ("column_name", "column_type", "field_number")
+_KEYWORDS = {"and", "or", "not", "in", "is", "null", "true", "false", "like", "ilike", "rlike", "regexp",
+             "between"}
+
+
+def _unescape(escaped) -> str:
+    # Spark's unescapeSQLString; \\% and \\_ keep their backslash for LIKE patterns
+    character = escaped.group(1)
+    if character.isdigit() or character == "u":
+        raise UnsupportedExpression(escaped.group(0))
+    return {"b": "\b", "n": "\n", "r": "\r", "t": "\t", "Z": "\x1a", "%": "\\%", "_": "\\_"}.get(
+        character, character)
+
+
+def _tokenize(expression: str):
+    tokens, position = [], 0
+    while position < len(expression):
+        match = _TOKEN_PATTERN.match(expression, position)
+        if match is None:
+            raise UnsupportedExpression(expression[position:])
+        position = match.end()
+        kind = match.lastgroup
+        if kind is None:
+            continue
+        text = match.group(kind)
+        if kind == "string":
+            value = re.sub(r"\\(.)", _unescape, text[1:-1], flags=re.DOTALL)
+            # Spark concatenates adjacent string literals
+            if tokens and tokens[-1][0] == "string":
+                tokens[-1] = ("string", tokens[-1][1] + value)
+                continue
+            tokens.append(("string", value))
+        elif kind == "number":
+            tokens.append(("number", float(text) if any(c in text for c in ".eE") else int(text)))
+        elif kind == "quoted":
+            tokens.append(("name", text[1:-1].replace("``", "`").lower()))
+        elif kind == "word" and text.lower() in _KEYWORDS:
+            tokens.append(("keyword", text.lower()))
+        elif kind == "word":
+            tokens.append(("name", text.lower()))
+        else:
+            tokens.append(("operator", text))
+    tokens.append(("end", None))
+    return tokens
+
+
+class _PredicateParser:
+    """Recursive-descent parser producing a nested-tuple tree for _evaluate."""
+
+    def __init__(self, expression: str):
+        self.tokens = _tokenize(expression)
+        self.position = 0
+
+    def parse(self):
+        tree = self._or()
+        if self.tokens[self.position][0] != "end":
+            raise UnsupportedExpression(str(self.tokens[self.position][1]))
+        return tree
+
+    def _peek(self, kind, *values):
+        token_kind, token_value = self.tokens[self.position]
+        return token_kind == kind and (not values or token_value in values)
+
+    def _accept(self, kind, *values):
+        if self._peek(kind, *values):
+            self.position += 1
+            return self.tokens[self.position - 1][1]
+        return None
+
+    def _expect(self, kind, *values):
+        value = self._accept(kind, *values)
+        if value is None:
+            raise UnsupportedExpression(str(self.tokens[self.position][1]))
+        return value
+
+    def _or(self):
+        tree = self._and()
+        while self._accept("keyword", "or"):
+            tree = ("or", tree, self._and())
+        return tree
+
+    def _and(self):
+        tree = self._not()
+        while self._accept("keyword", "and"):
+            tree = ("and", tree, self._not())
+        return tree
+
+    def _not(self):
+        if self._accept("keyword", "not") or self._accept("operator", "!"):
+            return ("not", self._not())
+        return self._predicate()
+
+    def _predicate(self):
+        tree = self._additive()
+        operator = self._accept("operator", "=", "==", "!=", "<>", "<", "<=", ">", ">=")
+        if operator:
+            return ("compare", {"==": "=", "<>": "!="}.get(operator, operator), tree, self._additive())
+        if self._accept("keyword", "is"):
+            negated = bool(self._accept("keyword", "not"))
+            self._expect("keyword", "null")
+            return ("is_null", negated, tree)
+        negated = bool(self._accept("keyword", "not"))
+        if self._accept("keyword", "in"):
+            self._expect("operator", "(")
+            values = [self._additive()]
+            while self._accept("operator", ","):
+                values.append(self._additive())
+            self._expect("operator", ")")
+            return ("in", negated, tree, values)
+        if self._accept("keyword", "between"):
+            lower = self._additive()
+            self._expect("keyword", "and")
+            return ("between", negated, tree, lower, self._additive())
+        operator = self._accept("keyword", "like", "ilike", "rlike", "regexp")
+        if operator:
+            return ("match", negated, operator, tree, self._additive())
+        if negated:
+            raise UnsupportedExpression("not")
+        return tree
+
+    def _additive(self):
+        tree = self._multiplicative()
+        while True:
+            operator = self._accept("operator", "+", "-", "||")
+            if not operator:
+                return tree
+            tree = ("arithmetic", operator, tree, self._multiplicative())
+
+    def _multiplicative(self):
+        tree = self._unary()
+        while True:
+            operator = self._accept("operator", "*", "/", "%")
+            if not operator:
+                return tree
+            tree = ("arithmetic", operator, tree, self._unary())
+
+    def _unary(self):
+        if self._accept("operator", "-"):
+            return ("arithmetic", "-", ("literal", 0), self._unary())
+        if self._accept("operator", "+"):
+            return self._unary()
+        return self._primary()
+
+    def _primary(self):
+        kind, value = self.tokens[self.position]
+        if kind in ("string", "number"):
+            self.position += 1
+            return ("literal", value)
+        if self._accept("keyword", "true", "false", "null"):
+            return ("literal", {"true": True, "false": False, "null": None}[value])
+        if self._accept("operator", "("):
+            tree = self._or()
+            self._expect("operator", ")")
+            return tree
+        name = self._expect("name")
+        if self._accept("operator", "("):
+            if name not in _FUNCTIONS:
+                raise UnsupportedExpression(name)
+            arguments = []
+            if not self._accept("operator", ")"):
+                arguments.append(self._or())
+                while self._accept("operator", ","):
+                    arguments.append(self._or())
+                self._expect("operator", ")")
+            return ("function", name, arguments)
+        if name not in _METADATA_COLUMNS:
+            raise UnsupportedExpression(name)
+        return ("column", name)
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _coerce_pair(left, right):
+    # Spark casts a string compared with a number to that number's type
+    if _is_number(left) and isinstance(right, str):
+        right = _to_number(right)
+    elif isinstance(left, str) and _is_number(right):
+        left = _to_number(left)
+    elif type(left) is not type(right) and not (_is_number(left) and _is_number(right)):
+        raise UnsupportedExpression(f"{left!r} compared with {right!r}")
+    return left, right
+
+
+def _to_number(value: str):
+    try:
+        return int(value.strip())
+    except ValueError:
+        raise UnsupportedExpression(value)
+
+
+def _to_integer(value) -> int:
+    if isinstance(value, str):
+        return _to_number(value)
+    if not isinstance(value, int) or isinstance(value, bool):
+        raise UnsupportedExpression(repr(value))
+    return value
+
+
+def _to_string(value) -> str:
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (str, int)):
+        return str(value)
+    raise UnsupportedExpression(repr(value))
+
+
+def _substring(value: str, position: int, length: int = 2 ** 31 - 1) -> str:
+    # UTF8String.substringSQL: 1-based, negative positions count from the end
+    start = position - 1 if position > 0 else (len(value) + position if position < 0 else 0)
+    end = start + length
+    start = max(start, 0)
+    return value[start:end] if start < end else ""
+
+
+def _like_pattern(pattern: str) -> str:
+    regex, escaped = [], False
+    for character in pattern:
+        if escaped:
+            regex.append(re.escape(character))
+            escaped = False
+        elif character == "\\":
+            escaped = True
+        elif character == "%":
+            regex.append(".*")
+        elif character == "_":
+            regex.append(".")
+        else:
+            regex.append(re.escape(character))
+    if escaped:
+        raise UnsupportedExpression(pattern)
+    return "".join(regex)
+
+
+def _string_function(function, arity):
+    def call(*arguments):
+        if len(arguments) not in arity:
+            raise UnsupportedExpression(f"{len(arguments)} arguments")
+        if any(argument is None for argument in arguments):
+            return None
+        return function(*arguments)
+    return call
+
+
+_FUNCTIONS = {
+    "lower": _string_function(lambda value: _to_string(value).lower(), (1,)),
+    "lcase": _string_function(lambda value: _to_string(value).lower(), (1,)),
+    "upper": _string_function(lambda value: _to_string(value).upper(), (1,)),
+    "ucase": _string_function(lambda value: _to_string(value).upper(), (1,)),
+    "length": _string_function(lambda value: len(_to_string(value)), (1,)),
+    "char_length": _string_function(lambda value: len(_to_string(value)), (1,)),
+    "character_length": _string_function(lambda value: len(_to_string(value)), (1,)),
+    "trim": _string_function(lambda value: _to_string(value).strip(" "), (1,)),
+    "ltrim": _string_function(lambda value: _to_string(value).lstrip(" "), (1,)),
+    "rtrim": _string_function(lambda value: _to_string(value).rstrip(" "), (1,)),
+    "startswith": _string_function(lambda value, prefix: _to_string(value).startswith(_to_string(prefix)), (2,)),
+    "endswith": _string_function(lambda value, suffix: _to_string(value).endswith(_to_string(suffix)), (2,)),
+    "contains": _string_function(lambda value, part: _to_string(part) in _to_string(value), (2,)),
+    "instr": _string_function(lambda value, part: _to_string(value).find(_to_string(part)) + 1, (2,)),
+    "concat": _string_function(lambda *values: "".join(_to_string(value) for value in values), range(1, 256)),
+    "substring": _string_function(lambda value, *bounds: _substring(
+        _to_string(value), *(_to_integer(bound) for bound in bounds)), (2, 3)),
+    "substr": _string_function(lambda value, *bounds: _substring(
+        _to_string(value), *(_to_integer(bound) for bound in bounds)), (2, 3)),
+    "left": _string_function(lambda value, count: _substring(_to_string(value), 1, _to_integer(count))
+                             if _to_integer(count) > 0 else "", (2,)),
+    "right": _string_function(lambda value, count: _substring(_to_string(value), -_to_integer(count))
+                              if _to_integer(count) > 0 else "", (2,)),
+    "regexp_like": _string_function(lambda value, pattern: re.search(pattern, _to_string(value)) is not None, (2,)),
+}
+
+
+def _boolean(value):
+    if value is not None and not isinstance(value, bool):
+        raise UnsupportedExpression(repr(value))
+    return value
+
+
+def _evaluate(tree, column):
+    kind = tree[0]
+    if kind == "literal":
+        return tree[1]
+    if kind == "column":
+        return column[tree[1]]
+    if kind == "function":
+        return _FUNCTIONS[tree[1]](*(_evaluate(argument, column) for argument in tree[2]))
+    if kind == "not":
+        value = _boolean(_evaluate(tree[1], column))
+        return None if value is None else not value
+    if kind in ("and", "or"):
+        return _logical(kind, _evaluate(tree[1], column), _evaluate(tree[2], column))
+    if kind == "is_null":
+        return (_evaluate(tree[2], column) is None) != tree[1]
+    if kind == "compare":
+        return _compare(tree[1], _evaluate(tree[2], column), _evaluate(tree[3], column))
+    if kind == "in":
+        value = _evaluate(tree[2], column)
+        results = [_compare("=", value, _evaluate(option, column)) for option in tree[3]]
+        found = True if True in results else (None if None in results else False)
+        return None if found is None else found != tree[1]
+    if kind == "between":
+        value = _evaluate(tree[2], column)
+        found = _logical("and", _compare(">=", value, _evaluate(tree[3], column)),
+                         _compare("<=", value, _evaluate(tree[4], column)))
+        return None if found is None else found != tree[1]
+    if kind == "match":
+        value, pattern = _evaluate(tree[3], column), _evaluate(tree[4], column)
+        if value is None or pattern is None:
+            return None
+        value, pattern = _to_string(value), _to_string(pattern)
+        if tree[2] == "like":
+            found = re.fullmatch(_like_pattern(pattern), value, re.DOTALL) is not None
+        elif tree[2] == "ilike":
+            found = re.fullmatch(_like_pattern(pattern.lower()), value.lower(), re.DOTALL) is not None
+        else:
+            found = re.search(pattern, value) is not None
+        return found != tree[1]
+    if kind == "arithmetic":
+        return _arithmetic(tree[1], _evaluate(tree[2], column), _evaluate(tree[3], column))
+    raise UnsupportedExpression(kind)
+
+
+def _logical(operator, left, right):
+    # SQL three-valued logic
+    left, right = _boolean(left), _boolean(right)
+    decisive = operator == "or"
+    if left is decisive or right is decisive:
+        return decisive
+    return None if left is None or right is None else not decisive
+
+
+def _compare(operator, left, right):
+    if left is None or right is None:
+        return None
+    left, right = _coerce_pair(left, right)
+    return {"=": left == right, "!=": left != right, "<": left < right, "<=": left <= right,
+            ">": left > right, ">=": left >= right}[operator]
+
+
+def _arithmetic(operator, left, right):
+    if left is None or right is None:
+        return None
+    if operator == "||":
+        return _to_string(left) + _to_string(right)
+    if not (_is_number(left) and _is_number(right)):
+        raise UnsupportedExpression(f"{left!r} {operator} {right!r}")
+    if operator in ("/", "%") and right == 0:
+        raise UnsupportedExpression("division by zero")
+    if operator == "/":
+        return left / right
+    if operator == "%":
+        # Java remainder takes the sign of the dividend
+        return math.fmod(left, right) if isinstance(left, float) or isinstance(right, float) \
+            else int(math.copysign(abs(left) % abs(right), left))
+    return {"+": left + right, "-": left - right, "*": left * right}[operator]
+
+
+def evaluate_column_predicate(expression: str, fields: List[dict]) -> Optional[List[str]]:
+    """
+    Names of the fields for which the customExpression is true, evaluated without the warehouse.
+
+    Covers comparisons, AND/OR/NOT, [NOT] IN, BETWEEN, IS [NOT] NULL, LIKE/ILIKE/RLIKE, string
+    concatenation, arithmetic and common string functions over column_name, column_type and
+    field_number. Returns None when the expression uses anything else, so the macro evaluates it
+    on the warehouse instead.
+    """
+    if not expression or not expression.strip():
+        return None
+    try:
+        tree = _PredicateParser(expression).parse()
+        selected = []
+        for index, field in enumerate(fields):
+            column = {"column_name": field["name"], "column_type": field["dataType"], "field_number": index}
+            if _evaluate(tree, column) is True:
+                selected.append(field["name"])
+        return selected
+    except (UnsupportedExpression, re.error, RecursionError):
+        return None
+
+
+def expression_hash(expression: str) -> str:
+    """
+    MD5 of customExpression as the macro receives it, which local_md5 reproduces in the macro.
+
+    apply() passes the expression in a double-quoted Jinja literal, whose backslash escapes and
+    line breaks Jinja normalizes before the macro sees the value.
+    """
+    value = re.sub(r"\r\n|\r", "\n", expression)
+    try:
+        value = value.encode("ascii", "backslashreplace").decode("unicode-escape")
+    except UnicodeDecodeError:
+        pass
+    return hashlib.md5(value.encode("utf-8")).hexdigest()
+
+
 class DynamicSelect(MacroSpec):
     name: str = "DynamicSelect"
     projectName: str = "DatabricksSqlBasics"
@@ -38,6 +452,10 @@ class DynamicSelect(MacroSpec):
         targetTypes: str = ''
         # custom expression
         customExpression: str = ""
+        # JSON list of the columns selected by customExpression when it could be evaluated locally
+        evaluatedColumns: str = ''
+        # MD5 of the customExpression evaluatedColumns was computed from; the macro ignores a stale list
+        evaluatedExpressionHash: str = ''
 
     def get_relation_names(self, component: Component, context: SqlContext):
         all_upstream_nodes = []
@@ -131,6 +549,9 @@ class DynamicSelect(MacroSpec):
                                                                 "* **column_name** - Name of column, eg. name, country\n"
                                                                 "* **column_type** - Type of column, eg. String \n"
                                                                 "* **field_number** - Index of column in dataframe, eg. 0 for first column\n"
+                                                                "\n"
+                                                                "Comparisons, IN, BETWEEN, LIKE/RLIKE and common string functions "
+                                                                "over these columns are evaluated without querying the warehouse."
                                                             )
                                                         ]
                                                     )
@@ -206,12 +627,17 @@ class DynamicSelect(MacroSpec):
         schema = json.loads(str(newState.ports.inputs[0].schema).replace("'", '"'))
         fields_array = [{"name": field["name"], "dataType": field["dataType"]["type"]} for field in schema["fields"]]
         relation_name = self.get_relation_names(newState, context)
+        evaluated_columns = None
+        if newState.properties.selectUsing == "SELECT_EXPR":
+            evaluated_columns = evaluate_column_predicate(newState.properties.customExpression, fields_array)
 
         newProperties = dataclasses.replace(
             newState.properties,
             schema=json.dumps(fields_array),
             targetTypes=json.dumps(target_types),
-            relation_name = relation_name
+            relation_name = relation_name,
+            evaluatedColumns='' if evaluated_columns is None else json.dumps(evaluated_columns),
+            evaluatedExpressionHash='' if evaluated_columns is None else expression_hash(newState.properties.customExpression)
         )
         return newState.bindProperties(newProperties)
 
@@ -226,7 +652,9 @@ class DynamicSelect(MacroSpec):
         targetTypes = props.targetTypes
         selectUsing = f"'{props.selectUsing}'"
         customExpression = "\"" + props.customExpression + "\""
-        params = ",".join(x for x in [relation, schema, targetTypes, selectUsing, customExpression])
+        evaluatedColumns = props.evaluatedColumns if props.evaluatedColumns else "None"
+        evaluatedExpressionHash = f"'{props.evaluatedExpressionHash}'"
+        params = ",".join(x for x in [relation, schema, targetTypes, selectUsing, customExpression, evaluatedColumns, evaluatedExpressionHash])
         return f'{{{{ {resolved_macro_name}({params}) }}}}'
 
     def loadProperties(self, properties: MacroProperties) -> PropertiesType:
@@ -238,6 +666,8 @@ class DynamicSelect(MacroSpec):
             targetTypes=parametersMap.get('targetTypes'),
             customExpression=parametersMap.get('customExpression'),
             selectUsing=parametersMap.get('selectUsing')[1:-1],
+            evaluatedColumns=parametersMap.get('evaluatedColumns') or '',
+            evaluatedExpressionHash=parametersMap.get('evaluatedExpressionHash') or '',
             boolTypeChecked="Boolean" in targetTypesList,
             strTypeChecked="String" in targetTypesList,
             intTypeChecked="Integer" in targetTypesList,
@@ -264,6 +694,8 @@ class DynamicSelect(MacroSpec):
                 MacroParameter("targetTypes", properties.targetTypes),
                 MacroParameter("customExpression", properties.customExpression),
                 MacroParameter("selectUsing", properties.selectUsing),
+                MacroParameter("evaluatedColumns", properties.evaluatedColumns),
+                MacroParameter("evaluatedExpressionHash", properties.evaluatedExpressionHash),
             ],
         )
     def updateInputPortSlug(self, component: Component, context: SqlContext):
@@ -299,11 +731,16 @@ class DynamicSelect(MacroSpec):
         schema = json.loads(str(component.ports.inputs[0].schema).replace("'", '"'))
         fields_array = [{"name": field["name"], "dataType": field["dataType"]["type"]} for field in schema["fields"]]
         relation_name = self.get_relation_names(component, context)
+        evaluated_columns = None
+        if component.properties.selectUsing == "SELECT_EXPR":
+            evaluated_columns = evaluate_column_predicate(component.properties.customExpression, fields_array)
 
         newProperties = dataclasses.replace(
             component.properties,
             schema=json.dumps(fields_array),
             targetTypes=json.dumps(target_types),
-            relation_name = relation_name
+            relation_name = relation_name,
+            evaluatedColumns='' if evaluated_columns is None else json.dumps(evaluated_columns),
+            evaluatedExpressionHash='' if evaluated_columns is None else expression_hash(component.properties.customExpression)
         )
         return component.bindProperties(newProperties)
\ No newline at end of file
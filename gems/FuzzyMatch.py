@@ -10,6 +10,10 @@ class MatchField(ABC):
     pass
 
 
+class BlockingKey(ABC):
+    pass
+
+
 class FuzzyMatch(MacroSpec):
     name: str = "FuzzyMatch"
     projectName: str = "DatabricksSqlBasics"
@@ -20,6 +24,13 @@ class FuzzyMatch(MacroSpec):
     class AddMatchField(MatchField):
         columnName: str = ""
         matchFunction: str = "custom"
+        weight: float = 1.0
+
+    @dataclass(frozen=True)
+    class AddBlockingKey(BlockingKey):
+        columnName: str = ""
+        blockingMethod: str = "prefix"
+        keyLength: int = 3
 
     @dataclass(frozen=True)
     class FuzzyMatchProperties(MacroProperties):
@@ -30,7 +41,30 @@ class FuzzyMatch(MacroSpec):
         matchThresholdPercentage: int = 80
         activeTab: str = "configuration"
         includeSimilarityScore: bool = False
+        equiJoinExactFields: bool = False
+        scoringMode: str = "LONG"
+        lshColumns: List[str] = field(default_factory=list)
+        lshBands: int = 0
+        lshRowsPerBand: int = 5
+        lshShingleSize: int = 3
+        qgramColumn: str = ""
+        qgramSize: int = 2
+        outputMode: str = "PAIRS"
+        maxClusterIterations: int = 10
+        incrementalColumn: str = ""
+        referenceSourceId: str = ""
+        neighbourhoodColumn: str = ""
+        neighbourhoodWindowSize: int = 0
+        topK: int = 0
+        normalizedCacheTable: str = ""
+        maxBlockSize: int = 0
+        oversizedBlockAction: str = "skip"
+        reportOversizedBlocks: bool = False
+        maxCandidatePairs: int = 0
+        watermarkTable: str = ""
+        matchPairsModel: str = ""
         matchFields: List[MatchField] = field(default_factory=list)
+        blockingKeys: List[BlockingKey] = field(default_factory=list)
         relation_name: List[str] = field(default_factory=list)
 
     def get_relation_names(self, component: Component, context: SqlContext):
@@ -57,6 +91,11 @@ class FuzzyMatch(MacroSpec):
         _matchFields.append(self.AddMatchField())
         return state.bindProperties(dataclasses.replace(state.properties, matchFields=_matchFields))
 
+    def onAddBlockingKey(self, state: Component[FuzzyMatchProperties]):
+        _blockingKeys = state.properties.blockingKeys
+        _blockingKeys.append(self.AddBlockingKey())
+        return state.bindProperties(dataclasses.replace(state.properties, blockingKeys=_blockingKeys))
+
     def dialog(self) -> Dialog:
         configurations = (
             StackLayout()
@@ -74,11 +113,19 @@ class FuzzyMatch(MacroSpec):
                     StringExpr("MERGE"),
                 )
                 .then(
-                    SchemaColumnsDropdown("Source ID Field")
-                    .withSearchEnabled()
-                    .bindSchema("component.ports.inputs[0].schema")
-                    .bindProperty("sourceIdCol")
-                    .showErrorsFor("sourceIdCol")
+                    StackLayout()
+                    .addElement(
+                        SchemaColumnsDropdown("Source ID Field")
+                        .withSearchEnabled()
+                        .bindSchema("component.ports.inputs[0].schema")
+                        .bindProperty("sourceIdCol")
+                        .showErrorsFor("sourceIdCol")
+                    )
+                    .addElement(
+                        TextBox("Reference Source ID (optional)")
+                        .bindPlaceholder("Source ID value of the smaller reference source, compared against all other sources")
+                        .bindProperty("referenceSourceId")
+                    )
                 )
             )
             .addElement(
@@ -95,10 +142,101 @@ class FuzzyMatch(MacroSpec):
                           )
                 .bindProperty("matchThresholdPercentage"),
             )
+            .addElement(
+                ColumnsLayout("1rem")
+                .addColumn(
+                    NumberBox("LSH Bands (0 disables MinHash/LSH)", placeholder="0", minValueVar=0)
+                    .bindProperty("lshBands")
+                    , "0.5fr")
+                .addColumn(
+                    NumberBox("LSH Rows per Band", placeholder="5", minValueVar=1)
+                    .bindProperty("lshRowsPerBand")
+                    , "0.5fr")
+            )
+            .addElement(
+                NumberBox("LSH Shingle Size (characters per shingle)", placeholder="3", minValueVar=1)
+                .bindProperty("lshShingleSize")
+            )
+            .addElement(
+                SchemaColumnsDropdown("LSH Fields (defaults to all Levenshtein, Jaro-Winkler and token-set match fields)")
+                .withMultipleSelection()
+                .bindSchema("component.ports.inputs[0].schema")
+                .bindProperty("lshColumns")
+            )
+            .addElement(
+                ColumnsLayout("1rem")
+                .addColumn(
+                    SchemaColumnsDropdown("Q-gram Filter Field (exact candidate filter for a Levenshtein match field)")
+                    .withSearchEnabled()
+                    .bindSchema("component.ports.inputs[0].schema")
+                    .bindProperty("qgramColumn")
+                    .showErrorsFor("qgramColumn")
+                    , "0.7fr")
+                .addColumn(
+                    NumberBox("Q-gram Size", placeholder="2", minValueVar=1)
+                    .bindProperty("qgramSize")
+                    , "0.3fr")
+            )
+            .addElement(
+                SelectBox("Scoring Method")
+                .addOption("One row per match field (aggregated)", "LONG")
+                .addOption("One row per record pair (all fields in one row)", "WIDE")
+                .bindProperty("scoringMode")
+            )
+            .addElement(
+                ColumnsLayout("1rem")
+                .addColumn(
+                    SelectBox("Output")
+                    .addOption("Matched record pairs", "PAIRS")
+                    .addOption("Match group id per record", "GROUPS")
+                    .addOption("Normalized values (materialize as the cache model)", "NORMALIZED")
+                    .addOption("Input watermark (materialize as the watermark state model)", "WATERMARK")
+                    .bindProperty("outputMode")
+                    , "0.7fr")
+                .addColumn(
+                    NumberBox("Max Grouping Iterations", placeholder="10", minValueVar=1)
+                    .bindProperty("maxClusterIterations")
+                    , "0.3fr")
+            )
+            .addElement(
+                NumberBox("Best Matches per Record (0 keeps all matches above the threshold)", placeholder="0", minValueVar=0)
+                .bindProperty("topK")
+            )
+            .addElement(
+                NumberBox("Max Compared Pairs (0 disables the budget check; the estimate is returned in pair_estimate)", placeholder="0", minValueVar=0)
+                .bindProperty("maxCandidatePairs")
+            )
+            .addElement(
+                TextBox("Normalized Value Cache Table (optional)")
+                .bindPlaceholder("catalog.schema.table of a model using this gem with the 'Normalized values' output")
+                .bindProperty("normalizedCacheTable")
+            )
+            .addElement(
+                SchemaColumnsDropdown("Incremental Watermark Field (model must be incremental with unique_key "
+                                      "['record_id1', 'record_id2'])")
+                .withSearchEnabled()
+                .bindSchema("component.ports.inputs[0].schema")
+                .bindProperty("incrementalColumn")
+                .showErrorsFor("incrementalColumn")
+            )
+            .addElement(
+                TextBox("Watermark State Table (optional)")
+                .bindPlaceholder("catalog.schema.table of a model using this gem with the 'Input watermark' output")
+                .bindProperty("watermarkTable")
+            )
+            .addElement(
+                TextBox("Matched Pairs Model (for the 'Input watermark' output)")
+                .bindPlaceholder("name of the incremental model whose watermark this model stores")
+                .bindProperty("matchPairsModel")
+            )
             .addElement(
                 Checkbox("Include similarity score column").bindProperty(
                     "includeSimilarityScore")
             )
+            .addElement(
+                Checkbox("Require Exact, Equals, Phone and Phonetic fields to match (hash join)").bindProperty(
+                    "equiJoinExactFields")
+            )
         )
 
         matchFunction = (SelectBox("Match Function")
@@ -106,7 +244,9 @@ class FuzzyMatch(MacroSpec):
                          .addOption("Exact", "exact")
                          .addOption("Equals", "equals")
                          .addOption("Address", "address")
-                         .addOption("Name", "name")
+                         .addOption("Name (Jaro-Winkler)", "name")
+                         .addOption("Phonetic (Soundex)", "phonetic")
+                         .addOption("Token Set", "token_set")
                          .addOption("Phone", "phone")
                          .bindProperty("record.AddMatchField.matchFunction")
                          )
@@ -125,23 +265,117 @@ class FuzzyMatch(MacroSpec):
                         SchemaColumnsDropdown("Field Name")
                         .bindSchema("component.ports.inputs[0].schema")
                         .bindProperty("record.AddMatchField.columnName")
-                        , "0.5fr")
+                        , "0.4fr")
                     .addColumn(
                         matchFunction,
-                        "0.5fr"
+                        "0.4fr"
                     )
+                    .addColumn(
+                        NumberBox("Weight", placeholder="1", minValueVar=0)
+                        .bindProperty("record.AddMatchField.weight")
+                        , "0.2fr")
                 )
                 .addColumn(ListItemDelete("delete"), width="content")
             )
         ) \
             .addElement(SimpleButtonLayout("Add Match Field", self.onButtonClick))
 
+        blockingMethod = (SelectBox("Blocking Method")
+                          .addOption("Prefix", "prefix")
+                          .addOption("Soundex", "soundex")
+                          .addOption("First Token", "first_token")
+                          .addOption("Digits (zip/area code)", "digits")
+                          .addOption("Exact Value", "exact")
+                          .bindProperty("record.AddBlockingKey.blockingMethod")
+                          )
+
+        blockingKeys = StackLayout(gap=("1rem"), height=("100%")) \
+            .addElement(TitleElement("Blocking")) \
+            .addElement(
+            AlertBox(
+                variant="success",
+                _children=[
+                    Markdown(
+                        "Only record pairs sharing at least one blocking key value are compared. "
+                        "Leave empty to compare all record pairs."
+                        "\n"
+                        "* **Prefix** - First N characters of the normalized value\n"
+                        "* **Soundex** - Soundex code of the normalized value\n"
+                        "* **First Token** - First word of the normalized value\n"
+                        "* **Digits** - First N digits, eg. zip or phone area code (0 keeps all digits)\n"
+                        "* **Exact Value** - Whole normalized value\n"
+                    )
+                ]
+            )
+        ) \
+            .addElement(
+            OrderedList("Blocking Keys")
+            .bindProperty("blockingKeys")
+            .setEmptyContainerText("Add a blocking key")
+            .addElement(
+                ColumnsLayout(("1rem"), alignY=("end"))
+                .addColumn(
+                    ColumnsLayout("1rem")
+                    .addColumn(
+                        SchemaColumnsDropdown("Field Name")
+                        .bindSchema("component.ports.inputs[0].schema")
+                        .bindProperty("record.AddBlockingKey.columnName")
+                        , "0.4fr")
+                    .addColumn(
+                        blockingMethod,
+                        "0.4fr"
+                    )
+                    .addColumn(
+                        NumberBox("Length (Prefix and Digits)", placeholder="3", minValueVar=0)
+                        .bindProperty("record.AddBlockingKey.keyLength")
+                        , "0.2fr")
+                )
+                .addColumn(ListItemDelete("delete"), width="content")
+            )
+        ) \
+            .addElement(SimpleButtonLayout("Add Blocking Key", self.onAddBlockingKey)) \
+            .addElement(
+            ColumnsLayout("1rem")
+            .addColumn(
+                NumberBox("Max Block Size (0 disables the skew guard)", placeholder="0", minValueVar=0)
+                .bindProperty("maxBlockSize")
+                , "0.5fr")
+            .addColumn(
+                SelectBox("Oversized Blocks")
+                .addOption("Skip", "skip")
+                .addOption("Sample down to the max size", "sample")
+                .addOption("Salt into sub-blocks of the max size", "salt")
+                .bindProperty("oversizedBlockAction")
+                , "0.5fr")
+        ) \
+            .addElement(
+            Checkbox("Output the oversized blocks (blocking key, value and size) instead of matches")
+            .bindProperty("reportOversizedBlocks")
+        ) \
+            .addElement(TitleElement("Sorted Neighbourhood")) \
+            .addElement(
+            ColumnsLayout("1rem")
+            .addColumn(
+                SchemaColumnsDropdown("Sort Field (records are compared with their neighbours in this order)")
+                .withSearchEnabled()
+                .bindSchema("component.ports.inputs[0].schema")
+                .bindProperty("neighbourhoodColumn")
+                .showErrorsFor("neighbourhoodColumn")
+                , "0.7fr")
+            .addColumn(
+                NumberBox("Window Size (0 disables)", placeholder="0", minValueVar=0)
+                .bindProperty("neighbourhoodWindowSize")
+                , "0.3fr")
+        )
+
         tabs = Tabs() \
             .bindProperty("activeTab") \
             .addTabPane(
             TabPane("Configuration", "configuration").addElement(configurations)
         ).addTabPane(
             TabPane("Match Fields", "match_fields").addElement(matchFields)
+        ).addTabPane(
+            TabPane("Blocking", "blocking").addElement(blockingKeys)
         )
 
         return Dialog("FuzzyMatch") \
@@ -220,6 +454,77 @@ class FuzzyMatch(MacroSpec):
                 )
             )
 
+        blocking_key_columns = [key.columnName for key in component.properties.blockingKeys if key.columnName]
+        missing_blocking_columns = [col for col in blocking_key_columns if col not in field_names]
+
+        if missing_blocking_columns:
+            diagnostics.append(
+                Diagnostic(
+                    "component.properties.blockingKeys",
+                    f"Selected blocking key columns {missing_blocking_columns} are not present in input schema.",
+                    SeverityLevelEnum.Error
+                )
+            )
+
+        if len(component.properties.qgramColumn) > 0:
+            levenshtein_columns = [field.columnName for field in component.properties.matchFields
+                                   if field.matchFunction in ("custom", "address")]
+            if component.properties.qgramColumn not in levenshtein_columns:
+                diagnostics.append(
+                    Diagnostic(
+                        "component.properties.qgramColumn",
+                        f"Q-gram filter field {component.properties.qgramColumn} must be a Levenshtein match field.",
+                        SeverityLevelEnum.Error
+                    )
+                )
+
+        # Without any candidate generation every record pair is compared.
+        has_candidate_generation = (
+            len(component.properties.blockingKeys) > 0
+            or int(component.properties.lshBands or 0) > 0
+            or len(component.properties.qgramColumn) > 0
+            or (len(component.properties.neighbourhoodColumn) > 0 and int(component.properties.neighbourhoodWindowSize or 0) > 0)
+            or (component.properties.mode == "MERGE" and len(component.properties.referenceSourceId) > 0)
+            or (component.properties.equiJoinExactFields
+                and any(field.matchFunction in ("exact", "equals", "phone", "phonetic") for field in component.properties.matchFields))
+            or len(component.properties.incrementalColumn) > 0
+        )
+        # A pair budget fails runs over budget, so the cross join is then a deliberate choice.
+        if not has_candidate_generation and int(component.properties.maxCandidatePairs or 0) <= 0:
+            diagnostics.append(
+                Diagnostic(
+                    "component.properties.blockingKeys",
+                    "No blocking is configured, so all n * (n - 1) / 2 record pairs of the input are compared. "
+                    "Add blocking keys, or set Max Compared Pairs to fail runs that would compare more pairs.",
+                    SeverityLevelEnum.Warning
+                )
+            )
+
+        if component.properties.reportOversizedBlocks and (len(component.properties.blockingKeys) == 0 or int(component.properties.maxBlockSize or 0) <= 0):
+            diagnostics.append(
+                Diagnostic("component.properties.reportOversizedBlocks", "The oversized block report needs blocking keys and a Max Block Size.",
+                           SeverityLevelEnum.Error))
+
+        if len(component.properties.neighbourhoodColumn) > 0 and component.properties.neighbourhoodColumn not in field_names:
+            diagnostics.append(
+                Diagnostic("component.properties.neighbourhoodColumn", f"Selected sort column {component.properties.neighbourhoodColumn} is not present in input schema.",
+                           SeverityLevelEnum.Error))
+
+        if len(component.properties.incrementalColumn) > 0:
+            if component.properties.incrementalColumn not in field_names:
+                diagnostics.append(
+                    Diagnostic("component.properties.incrementalColumn", f"Selected incremental column {component.properties.incrementalColumn} is not present in input schema.",
+                               SeverityLevelEnum.Error))
+            if component.properties.outputMode == "GROUPS":
+                diagnostics.append(
+                    Diagnostic("component.properties.incrementalColumn", "Match groups cannot be computed incrementally; clear the incremental field or output record pairs.",
+                               SeverityLevelEnum.Error))
+
+        if component.properties.outputMode == "WATERMARK" and (len(component.properties.incrementalColumn) == 0 or len(component.properties.matchPairsModel) == 0):
+            diagnostics.append(
+                Diagnostic("component.properties.matchPairsModel", "The input watermark output needs the incremental watermark field and the matched pairs model.",
+                           SeverityLevelEnum.Error))
+
         return diagnostics
 
     def onChange(self, context: SqlContext, oldState: Component, newState: Component) -> Component:
@@ -242,6 +547,19 @@ class FuzzyMatch(MacroSpec):
         # Convert defaultdict to a regular dict.
         match_fields_map = dict(grouped_match_fields)
 
+        # Only fields with a non-default weight are passed on; the rest weigh 1.
+        match_field_weights = {
+            field.columnName: float(field.weight)
+            for field in props.matchFields
+            if field.columnName and field.weight is not None and float(field.weight) != 1.0
+        }
+
+        blocking_keys = [
+            {"columnName": key.columnName, "method": key.blockingMethod, "length": int(key.keyLength or 0)}
+            for key in props.blockingKeys
+            if key.columnName
+        ]
+
         arguments = [
             "'" + table_name + "'",
             "'" + props.mode + "'",
@@ -249,7 +567,30 @@ class FuzzyMatch(MacroSpec):
             "'" + props.recordIdCol + "'",
             str(match_fields_map),
             str(props.matchThresholdPercentage),
-            str(props.includeSimilarityScore).lower()
+            str(props.includeSimilarityScore).lower(),
+            str(blocking_keys),
+            str(props.equiJoinExactFields).lower(),
+            "'" + props.scoringMode + "'",
+            str(match_field_weights),
+            str(props.lshColumns),
+            str(int(props.lshBands or 0)),
+            str(int(props.lshRowsPerBand or 5)),
+            str(int(props.lshShingleSize or 3)),
+            "'" + props.qgramColumn + "'",
+            str(int(props.qgramSize or 2)),
+            "'" + ("OVERSIZED_BLOCKS" if props.reportOversizedBlocks else props.outputMode) + "'",
+            str(int(props.maxClusterIterations or 10)),
+            "'" + props.incrementalColumn + "'",
+            "'" + props.referenceSourceId + "'",
+            "'" + props.neighbourhoodColumn + "'",
+            str(int(props.neighbourhoodWindowSize or 0)),
+            str(int(props.topK or 0)),
+            "'" + props.normalizedCacheTable + "'",
+            str(int(props.maxBlockSize or 0)),
+            "'" + props.oversizedBlockAction + "'",
+            str(int(props.maxCandidatePairs or 0)),
+            "'" + props.watermarkTable + "'",
+            "'" + props.matchPairsModel + "'"
         ]
         params = ",".join([param for param in arguments])
         return f'{{{{ {resolved_macro_name}({params}) }}}}'
@@ -263,7 +604,28 @@ class FuzzyMatch(MacroSpec):
             sourceIdCol=parametersMap.get('sourceIdCol'),
             recordIdCol=parametersMap.get('recordIdCol'),
             matchThresholdPercentage=float(parametersMap.get('matchThresholdPercentage')),
-            includeSimilarityScore=parametersMap.get('includeSimilarityScore').lower() == 'true'
+            includeSimilarityScore=parametersMap.get('includeSimilarityScore').lower() == 'true',
+            equiJoinExactFields=(parametersMap.get('equiJoinExactFields') or 'false').lower() == 'true',
+            scoringMode=parametersMap.get('scoringMode') or 'LONG',
+            lshBands=int(float(parametersMap.get('lshBands') or 0)),
+            lshRowsPerBand=int(float(parametersMap.get('lshRowsPerBand') or 5)),
+            lshShingleSize=int(float(parametersMap.get('lshShingleSize') or 3)),
+            qgramColumn=parametersMap.get('qgramColumn') or '',
+            qgramSize=int(float(parametersMap.get('qgramSize') or 2)),
+            outputMode=(parametersMap.get('outputMode') or 'PAIRS') if parametersMap.get('outputMode') != 'OVERSIZED_BLOCKS' else 'PAIRS',
+            maxClusterIterations=int(float(parametersMap.get('maxClusterIterations') or 10)),
+            incrementalColumn=parametersMap.get('incrementalColumn') or '',
+            referenceSourceId=parametersMap.get('referenceSourceId') or '',
+            neighbourhoodColumn=parametersMap.get('neighbourhoodColumn') or '',
+            neighbourhoodWindowSize=int(float(parametersMap.get('neighbourhoodWindowSize') or 0)),
+            topK=int(float(parametersMap.get('topK') or 0)),
+            normalizedCacheTable=parametersMap.get('normalizedCacheTable') or '',
+            maxBlockSize=int(float(parametersMap.get('maxBlockSize') or 0)),
+            oversizedBlockAction=parametersMap.get('oversizedBlockAction') or 'skip',
+            reportOversizedBlocks=parametersMap.get('outputMode') == 'OVERSIZED_BLOCKS',
+            maxCandidatePairs=int(float(parametersMap.get('maxCandidatePairs') or 0)),
+            watermarkTable=parametersMap.get('watermarkTable') or '',
+            matchPairsModel=parametersMap.get('matchPairsModel') or ''
         )
 
     def unloadProperties(self, properties: PropertiesType) -> MacroProperties:
@@ -277,7 +639,27 @@ class FuzzyMatch(MacroSpec):
                 MacroParameter("sourceIdCol", properties.sourceIdCol),
                 MacroParameter("recordIdCol", properties.recordIdCol),
                 MacroParameter("matchThresholdPercentage", str(properties.matchThresholdPercentage)),
-                MacroParameter("includeSimilarityScore", str(properties.includeSimilarityScore).lower())
+                MacroParameter("includeSimilarityScore", str(properties.includeSimilarityScore).lower()),
+                MacroParameter("equiJoinExactFields", str(properties.equiJoinExactFields).lower()),
+                MacroParameter("scoringMode", properties.scoringMode),
+                MacroParameter("lshBands", str(properties.lshBands)),
+                MacroParameter("lshRowsPerBand", str(properties.lshRowsPerBand)),
+                MacroParameter("lshShingleSize", str(properties.lshShingleSize)),
+                MacroParameter("qgramColumn", properties.qgramColumn),
+                MacroParameter("qgramSize", str(properties.qgramSize)),
+                MacroParameter("outputMode", "OVERSIZED_BLOCKS" if properties.reportOversizedBlocks else properties.outputMode),
+                MacroParameter("maxClusterIterations", str(properties.maxClusterIterations)),
+                MacroParameter("incrementalColumn", properties.incrementalColumn),
+                MacroParameter("referenceSourceId", properties.referenceSourceId),
+                MacroParameter("neighbourhoodColumn", properties.neighbourhoodColumn),
+                MacroParameter("neighbourhoodWindowSize", str(properties.neighbourhoodWindowSize)),
+                MacroParameter("topK", str(properties.topK)),
+                MacroParameter("normalizedCacheTable", properties.normalizedCacheTable),
+                MacroParameter("maxBlockSize", str(properties.maxBlockSize)),
+                MacroParameter("oversizedBlockAction", properties.oversizedBlockAction),
+                MacroParameter("maxCandidatePairs", str(properties.maxCandidatePairs)),
+                MacroParameter("watermarkTable", properties.watermarkTable),
+                MacroParameter("matchPairsModel", properties.matchPairsModel)
             ],
         )
 
@@ -18,7 +18,7 @@ class GenerateRows(MacroSpec):
         loop_expr: Optional[str] = None
         column_name: Optional[str] = None
         max_rows: Optional[str] = None
-        force_mode: Optional[str] = "recursive"
+        force_mode: Optional[str] = "auto"
 
     def get_relation_names(self, component: Component, context: SqlContext):
         all_upstream_nodes = []
@@ -76,6 +76,13 @@ class GenerateRows(MacroSpec):
                 )
                 .addElement(TextBox("Max rows per iteration (default: 100000)").bindPlaceholder(
                     """100000""").bindProperty("max_rows"))
+                .addElement(
+                    SelectBox("Generation strategy")
+                    .addOption("Auto (sequence() for a literal start, constant step and simple bound)", "auto")
+                    .addOption("Recursive CTE", "recursive")
+                    .addOption("sequence() / explode", "sequence")
+                    .bindProperty("force_mode")
+                )
             )
         )
 
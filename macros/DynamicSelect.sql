@@ -1,4 +1,4 @@
-{%- macro DynamicSelect(relation, schema, targetTypes, selectUsing, customExpression='') -%}
+{%- macro DynamicSelect(relation, schema, targetTypes, selectUsing, customExpression='', evaluatedColumns=none, evaluatedExpressionHash='') -%}
 
     {%- set enriched_schema = [] -%}
     {%- for column in schema -%}
@@ -12,32 +12,45 @@
         {%- do enriched_schema.append(new_column) -%}
     {%- endfor -%}
 
+    {# Evaluate the expression for every column in one query: each column becomes a row of an
+       inline table exposing column_name, column_type and field_number to the predicate #}
+    {%- set matched_names = [] -%}
+    {%- if selectUsing == 'SELECT_EXPR' and evaluatedColumns is not none and evaluatedExpressionHash == local_md5(customExpression) -%}
+        {# The gem already evaluated this expression locally; no warehouse query is needed #}
+        {%- set matched_names = evaluatedColumns -%}
+    {%- elif selectUsing == 'SELECT_EXPR' and enriched_schema -%}
+        {%- set column_rows = [] -%}
+        {%- for column in enriched_schema -%}
+            {%- set literals = [] -%}
+            {%- for value in [column["name"], column["dataType"]] -%}
+                {%- do literals.append("'" ~ (value | string).replace("\\", "\\\\").replace("'", "\\'") ~ "'") -%}
+            {%- endfor -%}
+            {%- do literals.append(column["column_index"] | string) -%}
+            {%- do column_rows.append("(" ~ literals | join(", ") ~ ")") -%}
+        {%- endfor -%}
+        {%- set evaluation_query -%}
+            select column_name, ({{ customExpression }}) as result
+            from values {{ column_rows | join(", ") }} as dynamic_select_columns(column_name, column_type, field_number)
+        {%- endset -%}
+        {%- if execute -%}
+            {%- set evaluation_result = run_query(evaluation_query) -%}
+            {%- if evaluation_result -%}
+                {%- for row in evaluation_result.rows -%}
+                    {# Only add column if the evaluation result is true #}
+                    {%- if row[1] | string == "True" -%}
+                        {%- do matched_names.append(row[0]) -%}
+                    {%- endif -%}
+                {%- endfor -%}
+            {%- endif -%}
+        {%- endif -%}
+    {%- endif -%}
+
     {%- set selected_columns = [] -%}
     {%- for column in enriched_schema -%}
         {%- if selectUsing == 'SELECT_EXPR' -%}
-                {%- set expression_to_evaluate = customExpression -%}
-
-                {%- if "column_name" in expression_to_evaluate -%}
-                    {%- set expression_to_evaluate = expression_to_evaluate.replace(
-                        "column_name", "'" ~ column["name"] ~ "'") -%}
-                {%- endif -%}
-
-                {%- if "column_type" in expression_to_evaluate -%}
-                    {%- set expression_to_evaluate = expression_to_evaluate.replace(
-                        "column_type", "'" ~ column["dataType"] ~ "'") -%}
-                {%- endif -%}
-
-                {%- if "field_number" in expression_to_evaluate -%}
-                    {%- set expression_to_evaluate = expression_to_evaluate.replace(
-                        "field_number", "'" ~ column["column_index"] ~ "'") -%}
-                {%- endif -%}
-
-                {%- set evaluation_result = DatabricksSqlBasics.evaluate_expression(expression_to_evaluate) | trim -%}
-
-                {# Only add column if the evaluation result is true #}
-                {%- if evaluation_result == "True" -%}
-                    {%- do selected_columns.append("`" ~ column["name"] ~ "`") -%}
-                {%- endif -%}
+            {%- if column["name"] in matched_names -%}
+                {%- do selected_columns.append("`" ~ column["name"] ~ "`") -%}
+            {%- endif -%}
         {%- else -%}
             {# If no custom expression, select columns based on target types #}
             {%- if column["dataType"] in targetTypes -%}
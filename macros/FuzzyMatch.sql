@@ -5,18 +5,47 @@
     recordIdCol,
     matchFields,
     matchThresholdPercentage=0,
-    includeSimilarityScore=False
+    includeSimilarityScore=False,
+    blockingKeys=[],
+    equiJoinExactFields=False,
+    scoringMode='LONG',
+    matchFieldWeights={},
+    lshColumns=[],
+    lshBands=0,
+    lshRowsPerBand=5,
+    lshShingleSize=3,
+    qgramColumn='',
+    qgramSize=2,
+    outputMode='PAIRS',
+    maxClusterIterations=10,
+    incrementalColumn='',
+    referenceSourceId='',
+    neighbourhoodColumn='',
+    neighbourhoodWindowSize=0,
+    topK=0,
+    normalizedCacheTable='',
+    maxBlockSize=0,
+    oversizedBlockAction='skip',
+    maxCandidatePairs=0,
+    watermarkTable='',
+    matchPairsModel=''
     ) %}
 
 {%- if mode == 'PURGE' or mode == 'MERGE' -%}
-    {# Build individual SELECT statements for each match field #}
-    {%- set selects = [] -%}
+    {# Collect the normalized value of each match field; all of them are projected in a single scan #}
+    {%- set match_field_list = [] -%}
+    {%- set equality_keys = [] -%}
     {%- for key, columns in matchFields.items() -%}
         {# Decide on the function name based on the key #}
         {%- if key == 'custom' -%}
             {%- set func_name = 'LEVENSHTEIN' -%}
         {%- elif key == 'name' -%}
-            {%- set func_name = 'LEVENSHTEIN' -%}
+            {%- set func_name = 'JARO_WINKLER' -%}
+        {%- elif key == 'phonetic' -%}
+            {# Soundex codes are compared for equality, so they can also be equi-joined #}
+            {%- set func_name = 'EQUALS' -%}
+        {%- elif key == 'token_set' -%}
+            {%- set func_name = 'TOKEN_SET' -%}
         {%- elif key == 'phone' -%}
             {%- set func_name = 'EQUALS' -%}
         {%- elif key == 'address' -%}
@@ -40,26 +69,838 @@
             {%- elif key == 'address' -%}
                 {# For address matching, strip punctuation from the column value #}
                 {%- set column_value_expr = "UPPER(REGEXP_REPLACE(CAST(" ~ quoted_col ~ " AS STRING), '[[:punct:]]', ''))" -%}
+            {%- elif key == 'phonetic' -%}
+                {# Java regular expressions have no POSIX bracket classes, so punctuation is \p{Punct} #}
+                {%- set column_value_expr = "NULLIF(SOUNDEX(TRIM(UPPER(REGEXP_REPLACE(CAST(" ~ quoted_col ~ " AS STRING), '\\\\p{Punct}', '')))), '')" -%}
+            {%- elif key == 'token_set' -%}
+                {# Tokens are separated by single spaces after stripping punctuation #}
+                {%- set column_value_expr = "TRIM(REGEXP_REPLACE(UPPER(REGEXP_REPLACE(CAST(" ~ quoted_col ~ " AS STRING), '\\\\p{Punct}', '')), '\\\\s+', ' '))" -%}
             {%- else -%}
                 {%- set column_value_expr = "CAST(" ~ quoted_col ~ " AS STRING)" -%}
             {%- endif -%}
 
-            {%- if mode == 'PURGE' -%}
-                {%- set select_stmt = "select CAST(" ~ recordIdCol ~ " AS STRING) as record_id, upper('" ~ col ~ "') as column_name, " ~ column_value_expr ~ " as column_value, '" ~ func_name ~ "' as function_name from " ~ relation -%}
-            {%- elif mode == 'MERGE' -%}
-                {%- set select_stmt = "select CAST(" ~ recordIdCol ~ " AS STRING) as record_id, CAST(" ~ sourceIdCol ~ " AS STRING) as source_id , upper('" ~ col ~ "') as column_name, " ~ column_value_expr ~ " as column_value, '" ~ func_name ~ "' as function_name from " ~ relation -%}
+            {%- set value_col = "match_value_" ~ (match_field_list | length) -%}
+            {%- do match_field_list.append({
+                "column": col,
+                "function": func_name,
+                "value_expr": column_value_expr,
+                "value_col": value_col,
+                "length_col": "match_length_" ~ (match_field_list | length),
+                "weight": matchFieldWeights.get(col, 1) | float
+            }) -%}
+
+            {# EQUALS/EXACT fields can only score 0 or 100, so they can be matched with a hash equi-join #}
+            {%- if equiJoinExactFields and func_name == 'EQUALS' -%}
+                {%- do equality_keys.append(value_col) -%}
+            {%- elif equiJoinExactFields and func_name == 'EXACT' -%}
+                {# EXACT compares a value to the reverse of the other, so join on an order-independent key #}
+                {%- do equality_keys.append("LEAST(" ~ value_col ~ ", REVERSE(" ~ value_col ~ "))") -%}
+            {%- endif -%}
+        {%- endfor -%}
+
+    {%- endfor -%}
+
+    {%- set match_field_count = match_field_list | length -%}
+    {%- set is_weighted = match_field_list | selectattr("weight", "ne", 1.0) | list | length > 0 -%}
+    {%- set total_weight = match_field_list | sum(attribute="weight") -%}
+
+    {#
+        A LEVENSHTEIN score can never exceed LEAST(len1, len2) / GREATEST(len1, len2) * 100.
+        For the weighted average over all match fields to reach the threshold, a field with
+        weight w needs at least 100 - (100 - threshold) * total_weight / w, so pairs whose
+        length ratio is below that bound are pruned before the distance is computed. The
+        threshold is lowered by 0.01 to allow for the rounding applied in final_output.
+    #}
+    {%- set pruned_fields = [] -%}
+    {%- for match_field in match_field_list -%}
+        {%- set min_field_score = none -%}
+        {%- if match_field.function == 'LEVENSHTEIN' and match_field.weight > 0 -%}
+            {%- set min_field_score = (100 - (100 - ((matchThresholdPercentage | float) - 0.01)) * total_weight / match_field.weight) | round(4) -%}
+        {%- endif -%}
+        {%- if min_field_score is not none and min_field_score > 0 -%}
+            {%- do match_field.update({"min_score": min_field_score}) -%}
+            {%- do pruned_fields.append(match_field.value_col) -%}
+        {%- else -%}
+            {%- do match_field.update({"min_score": none}) -%}
+        {%- endif -%}
+    {%- endfor -%}
+    {%- set length_pruning_enabled = pruned_fields | length > 0 -%}
+    {%- set length_bound_failed = "df0.function_name = 'LEVENSHTEIN' and LEAST(df0.column_length, df1.column_length) * 100 < df0.min_field_score * GREATEST(df0.column_length, df1.column_length)" -%}
+
+    {%- set match_value_columns = [] -%}
+    {%- set stack_args = [] -%}
+    {%- for match_field in match_field_list -%}
+        {%- do match_value_columns.append(match_field.value_expr ~ " as " ~ match_field.value_col) -%}
+        {%- set stack_arg = "upper('" ~ match_field.column ~ "'), '" ~ match_field.function ~ "', " ~ match_field.value_col -%}
+        {%- if is_weighted -%}
+            {%- set stack_arg = stack_arg ~ ", CAST(" ~ match_field.weight ~ " AS DOUBLE)" -%}
+        {%- endif -%}
+        {%- if length_pruning_enabled -%}
+            {%- set stack_arg = stack_arg ~ ", CAST(" ~ (match_field.min_score if match_field.min_score is not none else "NULL") ~ " AS DOUBLE)" -%}
+        {%- endif -%}
+        {%- do stack_args.append(stack_arg) -%}
+        {%- if scoringMode == 'WIDE' and match_field.min_score is not none -%}
+            {%- do match_value_columns.append("LENGTH(" ~ match_field.value_expr ~ ") as " ~ match_field.length_col) -%}
+        {%- endif -%}
+    {%- endfor -%}
+
+    {%- set equality_key_columns = [] -%}
+    {%- set equality_key_filters = [] -%}
+    {%- for key_expr in equality_keys -%}
+        {%- do equality_key_columns.append(key_expr ~ " as equality_key_" ~ loop.index0) -%}
+        {%- do equality_key_filters.append(key_expr ~ " is not null") -%}
+    {%- endfor -%}
+
+    {# Derive one block value per blocking key; only pairs sharing a block value are compared #}
+    {%- set block_value_columns = [] -%}
+    {%- set block_stack_args = [] -%}
+    {%- set block_labels = {} -%}
+    {%- for blocking_key in blockingKeys -%}
+        {%- set quoted_col = DatabricksSqlBasics.quote_identifier(blocking_key['columnName']) -%}
+        {%- set method = blocking_key.get('method', 'prefix') -%}
+        {%- set key_length = blocking_key.get('length', 0) | int -%}
+        {%- set normalized_expr = "TRIM(UPPER(REGEXP_REPLACE(CAST(" ~ quoted_col ~ " AS STRING), '\\\\p{Punct}', '')))" -%}
+        {%- if method == 'soundex' -%}
+            {%- set block_value_expr = "SOUNDEX(" ~ normalized_expr ~ ")" -%}
+        {%- elif method == 'first_token' -%}
+            {%- set block_value_expr = "SUBSTRING_INDEX(" ~ normalized_expr ~ ", ' ', 1)" -%}
+        {%- elif method == 'digits' -%}
+            {# Digits only, e.g. zip code or phone area code #}
+            {%- set block_value_expr = "REGEXP_REPLACE(CAST(" ~ quoted_col ~ " AS STRING), '[^0-9]', '')" -%}
+        {%- elif method == 'exact' -%}
+            {%- set block_value_expr = normalized_expr -%}
+        {%- else -%}
+            {%- set block_value_expr = normalized_expr -%}
+            {%- if key_length <= 0 -%}
+                {%- set key_length = 3 -%}
+            {%- endif -%}
+        {%- endif -%}
+        {# The length only applies to prefixes and digits; soundex codes, tokens and exact values are kept whole #}
+        {%- if key_length > 0 and method not in ['soundex', 'first_token', 'exact'] -%}
+            {%- set block_value_expr = "SUBSTRING(" ~ block_value_expr ~ ", 1, " ~ key_length ~ ")" -%}
+        {%- endif -%}
+
+        {%- do block_value_columns.append(block_value_expr ~ " as block_value_" ~ loop.index0) -%}
+        {%- do block_stack_args.append("'BLOCK_" ~ loop.index0 ~ "', block_value_" ~ loop.index0) -%}
+        {%- do block_labels.update({"BLOCK_" ~ loop.index0: blocking_key['columnName'] ~ " (" ~ method ~ ")"}) -%}
+    {%- endfor -%}
+
+    {#
+        MinHash/LSH: each text field is split into character shingles, lshBands * lshRowsPerBand
+        MinHash values are computed with seeded xxhash64, and every band of lshRowsPerBand values
+        becomes one more block value. Records colliding in at least one band are compared.
+        Without lshColumns all LEVENSHTEIN, JARO_WINKLER and TOKEN_SET match fields are used.
+    #}
+    {%- set lsh_shingle_columns = [] -%}
+    {%- set lsh_band_columns = [] -%}
+    {%- if lshBands | int > 0 -%}
+        {%- set shingle_size = lshShingleSize | int -%}
+        {%- set rows_per_band = [lshRowsPerBand | int, 1] | max -%}
+        {%- for match_field in match_field_list -%}
+            {%- if (lshColumns | length > 0 and match_field.column in lshColumns) or (lshColumns | length == 0 and match_field.function in ['LEVENSHTEIN', 'JARO_WINKLER', 'TOKEN_SET']) -%}
+                {%- set field_index = loop.index0 -%}
+                {%- set shingle_col = "lsh_shingles_" ~ field_index -%}
+                {%- do lsh_shingle_columns.append(
+                    "CASE WHEN LENGTH(" ~ match_field.value_col ~ ") > 0 THEN ARRAY_DISTINCT(TRANSFORM(SEQUENCE(1, GREATEST(LENGTH(" ~ match_field.value_col ~ ") - " ~ shingle_size ~ " + 1, 1)), pos -> SUBSTRING(" ~ match_field.value_col ~ ", pos, " ~ shingle_size ~ "))) END as " ~ shingle_col
+                ) -%}
+                {%- for band in range(lshBands | int) -%}
+                    {%- set min_hashes = [] -%}
+                    {%- for row in range(rows_per_band) -%}
+                        {%- do min_hashes.append("ARRAY_MIN(TRANSFORM(" ~ shingle_col ~ ", shingle -> XXHASH64(shingle, " ~ (band * rows_per_band + row) ~ ")))") -%}
+                    {%- endfor -%}
+                    {%- set band_col = "lsh_band_" ~ field_index ~ "_" ~ band -%}
+                    {# XXHASH64 of nulls is not null, so records without shingles get no band value #}
+                    {%- do lsh_band_columns.append("CASE WHEN " ~ shingle_col ~ " IS NOT NULL THEN CAST(XXHASH64(" ~ min_hashes | join(", ") ~ ") AS STRING) END as " ~ band_col) -%}
+                    {%- do block_stack_args.append("'LSH_" ~ field_index ~ "_" ~ band ~ "', " ~ band_col) -%}
+                    {%- do block_labels.update({"LSH_" ~ field_index ~ "_" ~ band: match_field.column ~ " (LSH band " ~ band ~ ")"}) -%}
+                {%- endfor -%}
             {%- endif -%}
+        {%- endfor -%}
+    {%- endif -%}
 
-            {%- do selects.append(select_stmt) -%}
+    {#
+        q-gram count filter: with k = FLOOR(len * (100 - min_score) / 100) edits allowed at
+        len = GREATEST(len1, len2), a pair within k edits shares at least len - q + 1 - q * k
+        q-grams. Pairs are generated from an inverted index on the q-grams of qgramColumn and
+        kept when their shared count meets that bound; pairs of values no longer than
+        qgram_short_length need no shared q-gram and are compared directly. A record whose
+        qgramColumn is null is paired with every record, as its score then ignores that field.
+        The filter is exact for the Levenshtein score of qgramColumn, so no pair reaching the
+        threshold is lost.
+    #}
+    {%- set qgram_fields = [] -%}
+    {%- set qgram_short_lengths = [] -%}
+    {%- set q = [qgramSize | int, 1] | max -%}
+    {%- if qgramColumn -%}
+        {%- for match_field in match_field_list if match_field.column == qgramColumn and match_field.function == 'LEVENSHTEIN' and match_field.min_score is not none -%}
+            {%- do qgram_fields.append(match_field) -%}
         {%- endfor -%}
+        {%- set max_edit_ratio = (100 - qgram_fields[0].min_score) / 100 if qgram_fields | length > 0 else 1 -%}
+        {%- if 1 - q * max_edit_ratio <= 0 -%}
+            {{ log("FuzzyMatch: the q-gram filter on " ~ qgramColumn ~ " cannot prune at this threshold and q-gram size; it is ignored", info=True) }}
+            {%- set qgram_fields = [] -%}
+        {%- else -%}
+            {# Past (q - 1) / (1 - q * max_edit_ratio) the required shared count is always positive #}
+            {%- for value_length in range(((q - 1) / (1 - q * max_edit_ratio)) | int + 2) -%}
+                {%- if value_length - q + 1 - q * ((value_length * max_edit_ratio) | int) <= 0 -%}
+                    {%- do qgram_short_lengths.append(value_length) -%}
+                {%- endif -%}
+            {%- endfor -%}
+        {%- endif -%}
+    {%- endif -%}
+    {%- set qgram_short_length = qgram_short_lengths | max if qgram_short_lengths | length > 0 else -1 -%}
+    {%- set candidate_sources = [] -%}
 
+    {#
+        Incremental runs only compare records whose incrementalColumn is past the watermark against
+        all records. Each pair is generated once, from its new side, and oriented so that record_id1
+        is still the greater id. Every pair row carries the watermark of its run (match_watermark),
+        and the model has to be materialized incremental with unique_key ['record_id1', 'record_id2']
+        so that re-found pairs are merged. A run without matches leaves no row, so its new records
+        are compared again next time; to avoid that, a second model with outputMode 'WATERMARK'
+        stores the input watermark after every run (it depends on matchPairsModel, so it runs after
+        the pairs model) and watermarkTable points the pairs model at it.
+    #}
+    {%- if incrementalColumn and outputMode == 'GROUPS' -%}
+        {{ exceptions.raise_compiler_error("FuzzyMatch: match groups need all pairs and cannot be computed incrementally") }}
+    {%- endif -%}
+    {%- if outputMode == 'WATERMARK' and not (incrementalColumn and matchPairsModel) -%}
+        {{ exceptions.raise_compiler_error("FuzzyMatch: the watermark state model needs the incremental watermark field and the pairs model it follows") }}
+    {%- endif -%}
+    {%- if incrementalColumn and outputMode not in ['NORMALIZED', 'OVERSIZED_BLOCKS', 'WATERMARK'] and execute -%}
+        {%- set unique_key = config.get('unique_key') -%}
+        {%- set unique_key = [unique_key] if unique_key is string else (unique_key or []) -%}
+        {%- if config.get('materialized') != 'incremental' or unique_key | map('lower') | sort | list != ['record_id1', 'record_id2'] -%}
+            {{ exceptions.raise_compiler_error("FuzzyMatch: an incremental watermark field needs the model to be materialized 'incremental' with unique_key ['record_id1', 'record_id2']") }}
+        {%- endif -%}
+    {%- endif -%}
+    {%- set incremental_run = incrementalColumn and outputMode not in ['OVERSIZED_BLOCKS', 'WATERMARK'] and is_incremental() -%}
+    {%- set watermark_relation = none -%}
+    {%- if incremental_run and watermarkTable and execute -%}
+        {# The state model only exists once it ran after the pairs model #}
+        {%- set watermark_parts = watermarkTable.split('.') -%}
+        {%- set watermark_relation = adapter.get_relation(
+            database=watermark_parts[-3] if watermark_parts | length > 2 else this.database,
+            schema=watermark_parts[-2] if watermark_parts | length > 1 else this.schema,
+            identifier=watermark_parts[-1]) -%}
+    {%- endif -%}
+    {%- set reference_source = mode == 'MERGE' and referenceSourceId | string | length > 0 -%}
+    {%- if reference_source -%}
+        {#
+            MERGE against a reference source: pairs always have the reference record on the left
+            and a record of another source on the right, so sources are never joined to themselves.
+        #}
+        {%- set reference_literal = "'" ~ (referenceSourceId | string | replace("'", "\\'")) ~ "'" -%}
+        {%- set pair_ids_template = "GREATEST({left}.record_id, {right}.record_id) as record_id1,\n        LEAST({left}.record_id, {right}.record_id) as record_id2" -%}
+        {%- set pair_order_template = "{left}.source_id = " ~ reference_literal ~ " and {right}.source_id <> " ~ reference_literal -%}
+        {%- if incremental_run -%}
+            {%- set pair_order_template = pair_order_template ~ " and ({left}.is_new_record or {right}.is_new_record)" -%}
+        {%- endif -%}
+    {%- elif incremental_run -%}
+        {%- set pair_ids_template = "GREATEST({left}.record_id, {right}.record_id) as record_id1,\n        LEAST({left}.record_id, {right}.record_id) as record_id2" -%}
+        {%- set pair_order_template = "{left}.is_new_record and (not {right}.is_new_record or {left}.record_id > {right}.record_id)" -%}
+    {%- else -%}
+        {%- set pair_ids_template = "{left}.record_id as record_id1,\n        {right}.record_id as record_id2" -%}
+        {%- set pair_order_template = "{left}.record_id > {right}.record_id" -%}
+    {%- endif -%}
+
+    {#
+        Sorted neighbourhood: records are sorted by the normalized neighbourhoodColumn and each is
+        compared with the next neighbourhoodWindowSize records. The window is partitioned by the
+        equality keys, or else by the first character of the sort key, so it is not evaluated in
+        a single partition; records are never neighbours across that boundary.
+    #}
+    {%- set neighbourhood_window = neighbourhoodWindowSize | int if neighbourhoodColumn else 0 -%}
+    {%- if neighbourhood_window > 0 -%}
+        {%- do block_value_columns.append("TRIM(UPPER(REGEXP_REPLACE(CAST(" ~ DatabricksSqlBasics.quote_identifier(neighbourhoodColumn) ~ " AS STRING), '\\\\p{Punct}', ''))) as neighbourhood_key") -%}
+        {%- set neighbourhood_partition = equality_keys if equality_keys | length > 0 else ["SUBSTRING(neighbourhood_key, 1, 1)"] -%}
+    {%- endif -%}
+
+    {# Without blocking keys the equality keys alone drive the candidate join #}
+    {%- if block_stack_args | length == 0 and qgram_fields | length == 0 and neighbourhood_window == 0 and equality_keys | length > 0 -%}
+        {%- do block_stack_args.append("'EQUALITY', 'EQUALITY'") -%}
+        {%- do block_labels.update({"EQUALITY": "required equal fields"}) -%}
+    {%- endif -%}
+    {%- if block_stack_args | length > 0 -%}
+        {%- do candidate_sources.append("blocking_pairs") -%}
+    {%- endif -%}
+    {%- if qgram_fields | length > 0 -%}
+        {%- do candidate_sources.append("qgram_pairs") -%}
+    {%- endif -%}
+    {%- if neighbourhood_window > 0 -%}
+        {%- do candidate_sources.append("neighbourhood_pairs") -%}
+    {%- endif -%}
+    {%- if (incremental_run or reference_source) and candidate_sources | length == 0 -%}
+        {%- do candidate_sources.append("unblocked_pairs") -%}
+    {%- endif -%}
+
+    {#
+        Skew guard: blocks with more than maxBlockSize records (e.g. a default phone number) are
+        skipped, sampled down to about maxBlockSize records, or salted into sub-blocks of that size.
+        outputMode 'OVERSIZED_BLOCKS' reports the capped blocks with their sizes instead of matches.
+    #}
+    {%- set max_block_size = maxBlockSize | int if block_stack_args | length > 0 else 0 -%}
+    {%- if outputMode == 'OVERSIZED_BLOCKS' and max_block_size <= 0 -%}
+        {{ exceptions.raise_compiler_error("FuzzyMatch: the oversized block report needs blocking keys and a maxBlockSize") }}
+    {%- endif -%}
+    {%- set block_group_columns = ["block_name", "block_value"] -%}
+    {%- for key_expr in equality_keys -%}
+        {%- do block_group_columns.append("equality_key_" ~ loop.index0) -%}
     {%- endfor -%}
 
-    {%- set match_function_cte = selects | join(" union all ") -%}
+    {# Normalized values, blocking values and lengths of each record #}
+    {%- set normalized_columns = ["CAST(" ~ recordIdCol ~ " AS STRING) as record_id"] -%}
+    {%- if mode == 'MERGE' -%}
+        {%- do normalized_columns.append("CAST(" ~ sourceIdCol ~ " AS STRING) as source_id") -%}
+    {%- endif -%}
+    {%- if incrementalColumn -%}
+        {%- do normalized_columns.append(DatabricksSqlBasics.quote_identifier(incrementalColumn) | trim ~ " as record_watermark") -%}
+    {%- endif -%}
+    {%- set normalized_columns = normalized_columns + match_value_columns + block_value_columns -%}
+    {%- set normalized_names = [] -%}
+    {%- for normalized_column in normalized_columns -%}
+        {%- do normalized_names.append(normalized_column.split(" as ") | last) -%}
+    {%- endfor -%}
+    {%- set watermark_ref = DatabricksSqlBasics.quote_identifier(incrementalColumn) | trim if incrementalColumn else none -%}
 
-with match_function as (
-    {{ match_function_cte }}
+    {#
+        Normalized value cache: outputMode 'NORMALIZED' emits the normalized columns of every record,
+        keyed by record_id, with a hash of the input columns they are derived from and a signature of
+        the normalization itself. Materialized as its own model (incremental with unique_key
+        'record_id' only renormalizes new or changed records), it is read back by a FuzzyMatch with the
+        same settings through normalizedCacheTable. Cached rows are only used while their row hash and
+        signature still match the input; other records are normalized on the fly.
+    #}
+    {%- set cache_input_columns = [recordIdCol] -%}
+    {%- for input_column in [sourceIdCol if mode == 'MERGE' else '', incrementalColumn, neighbourhoodColumn]
+            + (match_field_list | map(attribute="column") | list)
+            + (blockingKeys | map(attribute="columnName") | list) -%}
+        {%- if input_column and DatabricksSqlBasics.quote_identifier(input_column) | trim not in cache_input_columns -%}
+            {%- do cache_input_columns.append(DatabricksSqlBasics.quote_identifier(input_column) | trim) -%}
+        {%- endif -%}
+    {%- endfor -%}
+    {%- set cache_signature = local_md5(normalized_columns | join(", ")) -%}
+    {%- set row_hash_expr = "XXHASH64(" ~ cache_input_columns | join(", ") ~ ")" -%}
+    {%- set read_cache = normalizedCacheTable and outputMode != 'NORMALIZED' -%}
+    {%- if read_cache -%}
+        {%- set watermark_ref = "record_watermark" -%}
+    {%- endif -%}
+    {%- if outputMode == 'NORMALIZED' and execute and config.get('materialized') == 'incremental' -%}
+        {%- set unique_key = config.get('unique_key') -%}
+        {%- set unique_key = [unique_key] if unique_key is string else (unique_key or []) -%}
+        {%- if unique_key | map('lower') | list != ['record_id'] -%}
+            {{ exceptions.raise_compiler_error("FuzzyMatch: an incremental normalized value model needs unique_key 'record_id'") }}
+        {%- endif -%}
+    {%- endif -%}
+
+    {# LSH bands are hashes of the whole value and are left out of the pair estimate #}
+    {%- set reported_block_args = [] -%}
+    {%- for block_stack_arg in block_stack_args if not block_stack_arg.startswith("'LSH_") -%}
+        {%- do reported_block_args.append(block_stack_arg) -%}
+    {%- endfor -%}
+
+    {#
+        Pair budget: with maxCandidatePairs set, the number of compared pairs is estimated in SQL
+        before any pair is generated, and the run fails when the estimate exceeds the budget.
+        Runs within the budget return the estimate in a pair_estimate column.
+        Blocking keys are estimated from the block-size histogram, sorted neighbourhood as records
+        times window size, incremental or reference-source runs from the new or reference records,
+        and without any candidate generation the full cross join is counted. LSH and q-gram
+        candidates are not part of the estimate.
+    #}
+    {%- set pair_budget = maxCandidatePairs | int if outputMode not in ['NORMALIZED', 'OVERSIZED_BLOCKS', 'WATERMARK'] else 0 -%}
+    {%- set pair_estimate_terms = [] -%}
+    {%- if pair_budget > 0 -%}
+        {%- if reported_block_args | length > 0 -%}
+            {%- set block_pairs_expr = "block_size * (block_size - 1) / 2" -%}
+            {%- if max_block_size > 0 and oversizedBlockAction == 'sample' -%}
+                {%- set block_pairs_expr = "LEAST(block_size, " ~ max_block_size ~ ") * (LEAST(block_size, " ~ max_block_size ~ ") - 1) / 2" -%}
+            {%- elif max_block_size > 0 and oversizedBlockAction == 'salt' -%}
+                {%- set block_pairs_expr = "block_size * (LEAST(block_size, " ~ max_block_size ~ ") - 1) / 2" -%}
+            {%- endif -%}
+            {%- set blocking_estimate -%}
+            (
+                select coalesce(sum({{ block_pairs_expr }}), 0)
+                from (
+                    select CAST(count(*) AS DOUBLE) as block_size
+                    from unchecked_match_values
+                    lateral view stack({{ reported_block_args | length }}, {{ reported_block_args | join(", ") }}) block_stack as block_name, block_value
+                    where block_value is not null
+                      and block_value <> ''
+                    {%- for key_filter in equality_key_filters %}
+                      and {{ key_filter }}
+                    {%- endfor %}
+                    group by {{ (["block_name", "block_value"] + equality_keys) | join(", ") }}
+                ) as block_sizes
+                {%- if max_block_size > 0 and oversizedBlockAction not in ['sample', 'salt'] %}
+                where block_size <= {{ max_block_size }}
+                {%- endif %}
+            )
+            {%- endset -%}
+            {%- do pair_estimate_terms.append(blocking_estimate) -%}
+        {%- endif -%}
+        {%- if neighbourhood_window > 0 -%}
+            {%- do pair_estimate_terms.append("(select CAST(count(*) AS DOUBLE) * " ~ neighbourhood_window ~ " from unchecked_match_values where neighbourhood_key is not null and neighbourhood_key <> '')") -%}
+        {%- endif -%}
+        {%- if 'unblocked_pairs' in candidate_sources and reference_source -%}
+            {%- do pair_estimate_terms.append("(select CAST(count_if(source_id = " ~ reference_literal ~ ") AS DOUBLE) * count_if(source_id <> " ~ reference_literal ~ ") from unchecked_match_values)") -%}
+        {%- elif 'unblocked_pairs' in candidate_sources -%}
+            {%- do pair_estimate_terms.append("(select CAST(count_if(is_new_record) AS DOUBLE) * count(*) from unchecked_match_values)") -%}
+        {%- elif candidate_sources | length == 0 and mode == 'MERGE' -%}
+            {# Pairs of records from different sources #}
+            {%- do pair_estimate_terms.append("(select (sum(source_size) * sum(source_size) - sum(source_size * source_size)) / 2 from (select CAST(count(*) AS DOUBLE) as source_size from unchecked_match_values group by source_id) as source_sizes)") -%}
+        {%- elif candidate_sources | length == 0 -%}
+            {%- do pair_estimate_terms.append("(select CAST(count(*) AS DOUBLE) * (count(*) - 1) / 2 from unchecked_match_values)") -%}
+        {%- endif -%}
+        {%- if pair_estimate_terms | length == 0 and execute -%}
+            {{ log("FuzzyMatch: LSH and q-gram candidates cannot be estimated; maxCandidatePairs is not checked", info=True) }}
+        {%- elif execute -%}
+            {{ log("FuzzyMatch: the compared pairs are estimated at run time against maxCandidatePairs = " ~ pair_budget ~ "; every output row carries the estimate in pair_estimate", info=True) }}
+        {%- endif -%}
+    {%- endif -%}
+    {%- set pair_budget_enabled = pair_estimate_terms | length > 0 -%}
+
+{%- if outputMode == 'WATERMARK' %}
+-- depends_on: {{ ref(matchPairsModel) }}
+select max({{ DatabricksSqlBasics.quote_identifier(incrementalColumn) | trim }}) as match_watermark
+from {{ relation }}
+{%- elif outputMode == 'NORMALIZED' %}
+select
+    {{ normalized_columns | join(",\n    ") }},
+    row_hash,
+    '{{ cache_signature }}' as cache_signature
+from (
+    select *, {{ row_hash_expr }} as row_hash from {{ relation }}
+) as source_records
+{%- if is_incremental() %}
+{# Records already cached with the same input hash and normalization are not renormalized #}
+where not exists (
+    select 1 from {{ this }} as cache
+    where cache.record_id = CAST(source_records.{{ recordIdCol }} AS STRING)
+      and cache.row_hash = source_records.row_hash
+      and cache.cache_signature = '{{ cache_signature }}'
+)
+{%- endif %}
+{%- else %}
+with {% if incremental_run -%}
+incremental_watermark as (
+    select max(match_watermark) as match_watermark
+    from (
+        select match_watermark from {{ this }}
+        {%- if watermark_relation is not none %}
+        union all
+        select match_watermark from {{ watermarkTable }}
+        {%- endif %}
+    ) as stored_watermarks
+),
+{% endif -%}
+{%- if read_cache -%}
+cache_keys as (
+    select
+        CAST({{ recordIdCol }} AS STRING) as record_id,
+        {{ row_hash_expr }} as row_hash
+    from {{ relation }}
+),
+{% endif -%}
+{{ 'unchecked_match_values' if pair_budget_enabled else 'match_values' }} as (
+    select
+        {%- if incremental_run %}
+        {# Without a stored watermark every record is new #}
+        case
+            when (select match_watermark from incremental_watermark) is null then true
+            else coalesce({{ watermark_ref }} > (select match_watermark from incremental_watermark), false)
+        end as is_new_record,
+        {%- endif %}
+        {%- if read_cache %}
+        {{ normalized_names | join(",\n        ") }}
+    from (
+        select cache.{{ normalized_names | join(", cache.") }}
+        from {{ normalizedCacheTable }} as cache
+        inner join cache_keys
+            on cache_keys.record_id = cache.record_id
+           and cache_keys.row_hash = cache.row_hash
+        where cache.cache_signature = '{{ cache_signature }}'
+        union all
+        {# Records missing from the cache, changed since or normalized differently #}
+        select
+            {{ normalized_columns | join(",\n            ") }}
+        from {{ relation }}
+        where CAST({{ recordIdCol }} AS STRING) in (
+            select cache_keys.record_id
+            from cache_keys
+            left anti join {{ normalizedCacheTable }} as cache
+                on cache.record_id = cache_keys.record_id
+               and cache.row_hash = cache_keys.row_hash
+               and cache.cache_signature = '{{ cache_signature }}'
+        )
+    ) as normalized_values
+        {%- else %}
+        {{ normalized_columns | join(",\n        ") }}
+    from {{ relation }}
+        {%- endif %}
+),
+{%- if pair_budget_enabled %}
+pair_estimate as (
+    select
+        {{ pair_estimate_terms | join("\n        + ") }} as pair_estimate
+),
+{# The estimate is a scalar subquery, so it is computed first and the check fails the run before pairs are generated #}
+match_values as (
+    select *
+    from unchecked_match_values
+    where assert_true(
+        (select pair_estimate from pair_estimate) <= {{ pair_budget }},
+        concat('FuzzyMatch: about ', format_number((select pair_estimate from pair_estimate), 0),
+               ' record pairs would be compared, above the budget of {{ pair_budget }}. Add or tighten blocking keys, or raise maxCandidatePairs.')
+    ) is null
+),
+{%- endif %}
+{%- if lsh_band_columns | length > 0 %}
+lsh_shingles as (
+    select
+        *,
+        {{ lsh_shingle_columns | join(",\n        ") }}
+    from match_values
+),
+lsh_bands as (
+    select
+        *,
+        {{ lsh_band_columns | join(",\n        ") }}
+    from lsh_shingles
+),
+{%- endif %}
+{%- if block_stack_args | length > 0 %}
+{{ 'raw_blocking_keys' if max_block_size > 0 else 'blocking_keys' }} as (
+    select
+        record_id,
+        {%- if mode == 'MERGE' %}
+        source_id,
+        {%- endif %}
+        {%- for key_column in equality_key_columns %}
+        {{ key_column }},
+        {%- endfor %}
+        {%- if incremental_run %}
+        is_new_record,
+        {%- endif %}
+        block_name,
+        block_value
+    from {{ 'lsh_bands' if lsh_band_columns | length > 0 else 'match_values' }}
+    lateral view stack({{ block_stack_args | length }}, {{ block_stack_args | join(", ") }}) block_stack as block_name, block_value
+    where block_value is not null
+      and block_value <> ''
+    {%- for key_filter in equality_key_filters %}
+      and {{ key_filter }}
+    {%- endfor %}
+),
+{%- if max_block_size > 0 %}
+oversized_blocks as (
+    select
+        {{ block_group_columns | join(",\n        ") }},
+        count(*) as block_size
+    from raw_blocking_keys
+    group by {{ block_group_columns | join(", ") }}
+    having count(*) > {{ max_block_size }}
+),
+blocking_keys as (
+    select /*+ BROADCAST(ob) */
+        {%- if oversizedBlockAction == 'salt' %}
+        bk.* except (block_value),
+        {# Oversized blocks are split into sub-blocks of about maxBlockSize records #}
+        case
+            when ob.block_size is null then bk.block_value
+            else concat(bk.block_value, '#', CAST(PMOD(XXHASH64(bk.record_id), CEIL(ob.block_size / {{ max_block_size }})) AS STRING))
+        end as block_value
+        {%- else %}
+        bk.*
+        {%- endif %}
+    from raw_blocking_keys as bk
+    left join oversized_blocks as ob
+        on ob.block_name = bk.block_name
+       and ob.block_value = bk.block_value
+    {%- for key_expr in equality_keys %}
+       and ob.equality_key_{{ loop.index0 }} = bk.equality_key_{{ loop.index0 }}
+    {%- endfor %}
+    {%- if oversizedBlockAction == 'sample' %}
+    {# About maxBlockSize records of each oversized block are kept #}
+    where ob.block_size is null
+       or PMOD(XXHASH64(bk.record_id), ob.block_size) < {{ max_block_size }}
+    {%- elif oversizedBlockAction != 'salt' %}
+    where ob.block_size is null
+    {%- endif %}
+),
+{%- endif %}
+blocking_pairs as (
+    select distinct
+        {{ pair_ids_template | replace("{left}", "b0") | replace("{right}", "b1") }}
+    from blocking_keys as b0
+    inner join blocking_keys as b1
+        on b0.block_name = b1.block_name
+       and b0.block_value = b1.block_value
+    {%- for key_expr in equality_keys %}
+       and b0.equality_key_{{ loop.index0 }} = b1.equality_key_{{ loop.index0 }}
+    {%- endfor %}
+    where {{ pair_order_template | replace("{left}", "b0") | replace("{right}", "b1") }}
+    {% if mode == 'MERGE' %}
+       and b0.source_id <> b1.source_id
+    {% endif %}
+),
+{%- endif %}
+{%- if qgram_fields | length > 0 %}
+{%- set qgram_field = qgram_fields[0] %}
+{%- set qgram_max_length = "GREATEST(g0.qgram_length, g1.qgram_length)" %}
+qgram_values as (
+    select
+        record_id,
+        {%- if mode == 'MERGE' %}
+        source_id,
+        {%- endif %}
+        {%- for key_column in equality_key_columns %}
+        {{ key_column }},
+        {%- endfor %}
+        {%- if incremental_run %}
+        is_new_record,
+        {%- endif %}
+        {{ qgram_field.value_col }} as qgram_value,
+        LENGTH({{ qgram_field.value_col }}) as qgram_length
+    from match_values
+    where true
+    {%- for key_filter in equality_key_filters %}
+      and {{ key_filter }}
+    {%- endfor %}
 ),
+qgram_tokens as (
+    select
+        record_id,
+        {%- if mode == 'MERGE' %}
+        source_id,
+        {%- endif %}
+        {%- for key_expr in equality_keys %}
+        equality_key_{{ loop.index0 }},
+        {%- endfor %}
+        {%- if incremental_run %}
+        is_new_record,
+        {%- endif %}
+        qgram_length,
+        qgram,
+        count(*) as qgram_count
+    from qgram_values
+    lateral view explode(TRANSFORM(SEQUENCE(1, qgram_length - {{ q }} + 1), pos -> SUBSTRING(qgram_value, pos, {{ q }}))) qgram_explode as qgram
+    where qgram_length >= {{ q }}
+    group by
+        record_id,
+        {%- if mode == 'MERGE' %}
+        source_id,
+        {%- endif %}
+        {%- for key_expr in equality_keys %}
+        equality_key_{{ loop.index0 }},
+        {%- endfor %}
+        {%- if incremental_run %}
+        is_new_record,
+        {%- endif %}
+        qgram_length,
+        qgram
+),
+qgram_pairs as (
+    select
+        {{ pair_ids_template | replace("{left}", "g0") | replace("{right}", "g1") }}
+    from qgram_tokens as g0
+    inner join qgram_tokens as g1
+        on g0.qgram = g1.qgram
+    {%- for key_expr in equality_keys %}
+       and g0.equality_key_{{ loop.index0 }} = g1.equality_key_{{ loop.index0 }}
+    {%- endfor %}
+    where {{ pair_order_template | replace("{left}", "g0") | replace("{right}", "g1") }}
+    {%- if mode == 'MERGE' %}
+       and g0.source_id <> g1.source_id
+    {%- endif %}
+       and LEAST(g0.qgram_length, g1.qgram_length) * 100 >= {{ qgram_field.min_score }} * {{ qgram_max_length }}
+    group by
+        g0.record_id,
+        g1.record_id,
+        g0.qgram_length,
+        g1.qgram_length
+    having SUM(LEAST(g0.qgram_count, g1.qgram_count)) >= {{ qgram_max_length }} - {{ q }} + 1 - {{ q }} * FLOOR({{ qgram_max_length }} * (100 - {{ qgram_field.min_score }}) / 100)
+    {%- if qgram_short_length >= 0 %}
+    {# Short values may reach the threshold without sharing a q-gram #}
+    union
+    select
+        {{ pair_ids_template | replace("{left}", "g0") | replace("{right}", "g1") }}
+    from qgram_values as g0
+    inner join qgram_values as g1
+        on {{ pair_order_template | replace("{left}", "g0") | replace("{right}", "g1") }}
+    {%- for key_expr in equality_keys %}
+       and g0.equality_key_{{ loop.index0 }} = g1.equality_key_{{ loop.index0 }}
+    {%- endfor %}
+    where g0.qgram_length <= {{ qgram_short_length }}
+      and g1.qgram_length <= {{ qgram_short_length }}
+    {%- if mode == 'MERGE' %}
+      and g0.source_id <> g1.source_id
+    {%- endif %}
+    {%- endif %}
+    {# Null values have no q-grams, so their pairs are left to the other match fields #}
+    union
+    select
+        {{ pair_ids_template | replace("{left}", "g0") | replace("{right}", "g1") }}
+    from qgram_values as g0
+    inner join qgram_values as g1
+        on {{ pair_order_template | replace("{left}", "g0") | replace("{right}", "g1") }}
+    {%- for key_expr in equality_keys %}
+       and g0.equality_key_{{ loop.index0 }} = g1.equality_key_{{ loop.index0 }}
+    {%- endfor %}
+    where (g0.qgram_length is null or g1.qgram_length is null)
+    {%- if mode == 'MERGE' %}
+      and g0.source_id <> g1.source_id
+    {%- endif %}
+),
+{%- endif %}
+{%- if neighbourhood_window > 0 %}
+neighbourhood_links as (
+    select
+        record_id,
+        neighbour_id
+    from (
+        select
+            record_id,
+            {%- for offset in range(1, neighbourhood_window + 1) %}
+            lead(record_id, {{ offset }}) over (partition by {{ neighbourhood_partition | join(", ") }} order by neighbourhood_key, record_id) as neighbour_id_{{ offset }}{{ "," if not loop.last }}
+            {%- endfor %}
+        from match_values
+        where neighbourhood_key is not null
+          and neighbourhood_key <> ''
+        {%- for key_filter in equality_key_filters %}
+          and {{ key_filter }}
+        {%- endfor %}
+    ) as neighbourhood_sorted
+    lateral view stack({{ neighbourhood_window }}{% for offset in range(1, neighbourhood_window + 1) %}, neighbour_id_{{ offset }}{% endfor %}) neighbour_stack as neighbour_id
+    where neighbour_id is not null
+),
+neighbourhood_pairs as (
+    {# Links are unordered, so both directions are offered and the pair order picks one #}
+    select distinct
+        {{ pair_ids_template | replace("{left}", "s0") | replace("{right}", "s1") }}
+    from (
+        select record_id, neighbour_id from neighbourhood_links
+        union all
+        select neighbour_id as record_id, record_id as neighbour_id from neighbourhood_links
+    ) as nl
+    inner join match_values as s0
+        on s0.record_id = nl.record_id
+    inner join match_values as s1
+        on s1.record_id = nl.neighbour_id
+    where {{ pair_order_template | replace("{left}", "s0") | replace("{right}", "s1") }}
+    {%- if mode == 'MERGE' %}
+       and s0.source_id <> s1.source_id
+    {%- endif %}
+),
+{%- endif %}
+{%- if 'unblocked_pairs' in candidate_sources %}
+unblocked_pairs as (
+    {# The reference source or the new records are the small side of this join #}
+    select /*+ BROADCAST(n0) */
+        {{ pair_ids_template | replace("{left}", "n0") | replace("{right}", "n1") }}
+    from match_values as n0
+    inner join match_values as n1
+        on {{ pair_order_template | replace("{left}", "n0") | replace("{right}", "n1") }}
+    {%- if mode == 'MERGE' %}
+       and n0.source_id <> n1.source_id
+    {%- endif %}
+),
+{%- endif %}
+{%- if candidate_sources | length > 0 %}
+candidate_pairs as (
+    {%- for candidate_source in candidate_sources %}
+    {%- if not loop.first %}
+    union
+    {%- endif %}
+    select record_id1, record_id2 from {{ candidate_source }}
+    {%- endfor %}
+),
+{%- endif %}
+{%- if scoringMode == 'WIDE' %}
+{# Each candidate pair is joined once and every match field is scored in its own column #}
+pair_scores as (
+    select
+        df0.record_id as record_id1,
+        df1.record_id as record_id2
+        {%- for match_field in match_field_list %},
+        {%- set value_1 = "df0." ~ match_field.value_col %}
+        {%- set value_2 = "df1." ~ match_field.value_col %}
+        {%- if match_field.function == 'EXACT' %}
+        case
+            when {{ value_1 }} = REVERSE({{ value_2 }}) then 100.0
+            when {{ value_1 }} <> REVERSE({{ value_2 }}) then 0.0
+        end as field_score_{{ loop.index0 }}
+        {%- elif match_field.function == 'EQUALS' %}
+        case
+            when {{ value_1 }} = {{ value_2 }} then 100.0
+            when {{ value_1 }} <> {{ value_2 }} then 0.0
+        end as field_score_{{ loop.index0 }}
+        {%- elif match_field.function == 'JARO_WINKLER' %}
+        {{ DatabricksSqlBasics.fuzzy_match_jaro_winkler(value_1, value_2) }} as field_score_{{ loop.index0 }}
+        {%- elif match_field.function == 'TOKEN_SET' %}
+        {{ DatabricksSqlBasics.fuzzy_match_token_set(value_1, value_2) }} as field_score_{{ loop.index0 }}
+        {%- else %}
+        (1 - ( LEVENSHTEIN({{ value_1 }}, {{ value_2 }}) / GREATEST(length({{ value_1 }}), length({{ value_2 }})))) * 100 as field_score_{{ loop.index0 }}
+        {%- endif %}
+        {%- endfor %}
+    {%- if candidate_sources | length > 0 %}
+    from candidate_pairs as cp
+    inner join match_values as df0
+        on df0.record_id = cp.record_id1
+    inner join match_values as df1
+        on df1.record_id = cp.record_id2
+    where df0.record_id > df1.record_id
+    {%- else %}
+    from match_values as df0
+    inner join match_values as df1
+        on df0.record_id > df1.record_id
+    where true
+    {%- endif %}
+    {% if mode == 'MERGE' %}
+       and df0.source_id <> df1.source_id
+    {% endif %}
+    {%- for match_field in match_field_list if match_field.min_score is not none %}
+       {# Failing the bound on any field means the pair cannot reach the threshold #}
+       and not coalesce(LEAST(df0.{{ match_field.length_col }}, df1.{{ match_field.length_col }}) * 100 < {{ match_field.min_score }} * GREATEST(df0.{{ match_field.length_col }}, df1.{{ match_field.length_col }}), false)
+    {%- endfor %}
+),
+{%- set weighted_scores = [] -%}
+{%- set scored_weights = [] -%}
+{%- for match_field in match_field_list -%}
+    {%- do weighted_scores.append("coalesce(field_score_" ~ loop.index0 ~ " * " ~ match_field.weight ~ ", 0)") -%}
+    {%- do scored_weights.append("case when field_score_" ~ loop.index0 ~ " is not null then " ~ match_field.weight ~ " else 0 end") -%}
+{%- endfor %}
+final_output as (
+    select
+        record_id1,
+        record_id2,
+        {# Null field scores are ignored, as avg() does in the long format #}
+        round(({{ weighted_scores | join(" + ") }}) / nullif({{ scored_weights | join(" + ") }}, 0), 2) as similarity_score
+    from pair_scores
+)
+{%- else %}
+match_function as (
+    select
+        record_id,
+        {%- if mode == 'MERGE' %}
+        source_id,
+        {%- endif %}
+        column_name,
+        column_value,
+        LENGTH(column_value) as column_length,
+        {%- if is_weighted %}
+        field_weight,
+        {%- endif %}
+        {%- if length_pruning_enabled %}
+        min_field_score,
+        {%- endif %}
+        function_name
+    from match_values
+    lateral view stack({{ stack_args | length }}, {{ stack_args | join(", ") }}) match_stack as column_name, function_name, column_value
+    {%- if is_weighted %}, field_weight{% endif %}
+    {%- if length_pruning_enabled %}, min_field_score{% endif %}
+),
+{# Each unordered pair is compared once, with the greater record id as record_id1 #}
 cross_join_data as (
     select
         df0.record_id as record_id1,
@@ -71,15 +912,36 @@ cross_join_data as (
         df0.column_value as column_value_1,
         df1.column_value as column_value_2,
         df0.column_name as column_name,
+        {%- if is_weighted %}
+        df0.field_weight as field_weight,
+        {%- endif %}
         df0.function_name as function_name
+        {%- if length_pruning_enabled and match_field_count > 1 %},
+        {{ length_bound_failed }} as length_bound_failed
+        {%- endif %}
+    {%- if candidate_sources | length > 0 %}
+    from candidate_pairs as cp
+    inner join match_function as df0
+        on df0.record_id = cp.record_id1
+    inner join match_function as df1
+        on df1.record_id = cp.record_id2
+       and df0.function_name = df1.function_name
+       and df0.column_name = df1.column_name
+    where df0.record_id > df1.record_id
+    {%- else %}
     from match_function as df0
     cross join match_function as df1
-    where df0.record_id <> df1.record_id
+    where df0.record_id > df1.record_id
       and df0.function_name = df1.function_name
       and df0.column_name = df1.column_name
+    {%- endif %}
     {% if mode == 'MERGE' %}
        and df0.source_id <> df1.source_id
     {% endif %}
+    {%- if length_pruning_enabled and match_field_count == 1 %}
+       {# With a single match field the whole pair can be dropped in the join #}
+       and not coalesce({{ length_bound_failed }}, false)
+    {%- endif %}
 ),
 impose_function_match as (
     select
@@ -90,8 +952,16 @@ impose_function_match as (
             source_id2,
         {%- endif -%}
         column_name,
+        {%- if is_weighted %}
+        field_weight,
+        {%- endif %}
         function_name,
         case
+            {%- if length_pruning_enabled and match_field_count > 1 %}
+            {# The pair cannot reach the threshold; skip the distance and score the field as 0 #}
+            when length_bound_failed then
+                0.0
+            {%- endif %}
             when function_name = 'LEVENSHTEIN' then
                 (1 - ( LEVENSHTEIN(column_value_1, column_value_2) / GREATEST(length(column_value_1), length(column_value_2)))) * 100
             when function_name = 'EXACT' AND (column_value_1 = REVERSE(column_value_2) AND column_value_2 = REVERSE(column_value_1)) then
@@ -102,48 +972,213 @@ impose_function_match as (
                 100.0
             when function_name = 'EQUALS' AND column_value_1 <> column_value_2 then
                 0.0
+            {%- if match_field_list | selectattr("function", "eq", "JARO_WINKLER") | list | length > 0 %}
+            when function_name = 'JARO_WINKLER' then
+                {{ DatabricksSqlBasics.fuzzy_match_jaro_winkler('column_value_1', 'column_value_2') }}
+            {%- endif %}
+            {%- if match_field_list | selectattr("function", "eq", "TOKEN_SET") | list | length > 0 %}
+            when function_name = 'TOKEN_SET' then
+                {{ DatabricksSqlBasics.fuzzy_match_token_set('column_value_1', 'column_value_2') }}
+            {%- endif %}
             else
                 {# Fallback to Levenshtein distance #}
                 (1 - ( LEVENSHTEIN(column_value_1, column_value_2) / GREATEST(length(column_value_1), length(column_value_2)))) * 100
         end as similarity_score
     from cross_join_data
 ),
-replace_record_ids as (
-    select
-        GREATEST(record_id1, record_id2) as record_id1,
-        LEAST(record_id1, record_id2) as record_id2,
-        column_name,
-        function_name,
-        similarity_score
-    from impose_function_match
-),
 final_output as (
     select
         record_id1,
         record_id2,
+        {%- if is_weighted %}
+        round(sum(similarity_score * field_weight) / nullif(sum(case when similarity_score is not null then field_weight else 0 end), 0), 2) as similarity_score
+        {%- else %}
         round(avg(similarity_score),2) as similarity_score
-    from replace_record_ids
+        {%- endif %}
+    from impose_function_match
     group by
     record_id1,
     record_id2
 )
+{%- endif %}
+    {%- set output_relation = 'final_output' %}
+    {%- if topK | int > 0 and outputMode != 'GROUPS' %},
+{#
+    Each pair is ranked from both of its records, so a record's matches count whether it is
+    record_id1 or record_id2. A pair is kept when it is among the topK best matches of either record.
+#}
+oriented_matches as (
+    select record_id1 as record_id, record_id2 as neighbour_id, record_id1, record_id2, similarity_score
+    from final_output
+    where similarity_score >= {{ matchThresholdPercentage }}
+    union all
+    select record_id2 as record_id, record_id1 as neighbour_id, record_id1, record_id2, similarity_score
+    from final_output
+    where similarity_score >= {{ matchThresholdPercentage }}
+),
+top_matches as (
+    select distinct
+        record_id1,
+        record_id2,
+        similarity_score
+    from (
+        select record_id1, record_id2, similarity_score
+        from oriented_matches
+        qualify row_number() over (partition by record_id order by similarity_score desc, neighbour_id) <= {{ topK | int }}
+    ) as ranked_matches
+)
+    {%- set output_relation = 'top_matches' %}
+    {%- endif %}
+    {%- if outputMode == 'GROUPS' %},
+{%- set cluster_iterations = [maxClusterIterations | int, 1] | max %}
+{#
+    Connected components by min-label propagation: every matched record starts with its own id
+    as label and each iteration takes the smallest label among itself and its neighbours. Groups
+    linked by a chain of more than maxClusterIterations matches may not fully converge.
+#}
+match_edges as (
+    select record_id1 as record_id, record_id2 as neighbour_id from final_output
+    where similarity_score >= {{ matchThresholdPercentage }}
+),
+match_neighbours as (
+    select record_id, neighbour_id from match_edges
+    union
+    select neighbour_id as record_id, record_id as neighbour_id from match_edges
+    union
+    select record_id, record_id as neighbour_id from match_edges
+    union
+    select neighbour_id as record_id, neighbour_id from match_edges
+),
+match_labels_0 as (
+    select distinct record_id, record_id as match_group_id from match_neighbours
+),
+{%- for iteration in range(1, cluster_iterations + 1) %}
+match_labels_{{ iteration }} as (
+    select
+        n.record_id,
+        min(l.match_group_id) as match_group_id
+    from match_neighbours as n
+    inner join match_labels_{{ iteration - 1 }} as l
+        on l.record_id = n.neighbour_id
+    group by n.record_id
+),
+{%- endfor %}
+match_groups as (
+    {# Records without any match form a group of their own #}
+    select
+        mv.record_id,
+        coalesce(ml.match_group_id, mv.record_id) as match_group_id
+    from match_values as mv
+    left join match_labels_{{ cluster_iterations }} as ml
+        on ml.record_id = mv.record_id
+)
+    select
+        record_id,
+        match_group_id
+        {%- if pair_budget_enabled %},
+        (select pair_estimate from pair_estimate) as pair_estimate
+        {%- endif %}
+    from match_groups
+    {%- elif outputMode == 'OVERSIZED_BLOCKS' %}
+        select
+            case block_name
+                {%- for block_name, block_label in block_labels.items() %}
+                when '{{ block_name }}' then '{{ block_label | replace("\\", "\\\\") | replace("'", "\\'") }}'
+                {%- endfor %}
+            end as blocking_key,
+            block_value,
+            {%- for key_expr in equality_keys %}
+            equality_key_{{ loop.index0 }},
+            {%- endfor %}
+            block_size,
+            '{{ oversizedBlockAction }}' as oversized_block_action
+        from oversized_blocks
     {# Include similarity score if True #}
-    {%- if includeSimilarityScore -%}
+    {%- elif includeSimilarityScore %}
         select
             record_id1,
             record_id2,
-            similarity_score from final_output
+            {%- if incrementalColumn %}
+            (select max(record_watermark) from match_values) as match_watermark,
+            {%- endif %}
+            {%- if pair_budget_enabled %}
+            (select pair_estimate from pair_estimate) as pair_estimate,
+            {%- endif %}
+            similarity_score from {{ output_relation }}
         where similarity_score >= {{ matchThresholdPercentage }}
-    {%- else -%}
+    {%- else %}
         select
             record_id1,
             record_id2
-            from final_output
+            {%- if incrementalColumn %},
+            (select max(record_watermark) from match_values) as match_watermark
+            {%- endif %}
+            {%- if pair_budget_enabled %},
+            (select pair_estimate from pair_estimate) as pair_estimate
+            {%- endif %}
+            from {{ output_relation }}
         where similarity_score >= {{ matchThresholdPercentage }}
     {%- endif -%}
+{%- endif -%}
 
 {%- else -%}
     select * from {{ relation }}
 {%- endif -%}
 
-{% endmacro %}
\ No newline at end of file
+{% endmacro %}
+
+{#
+    Jaro-Winkler similarity (0-100) of two string expressions, built from higher-order functions.
+    Characters of the first value are matched greedily to unused equal characters of the second
+    within the match window; the matched characters of both values in order give the transpositions.
+    The common prefix (up to 4 characters) boosts Jaro similarities above 0.7.
+#}
+{% macro fuzzy_match_jaro_winkler(value_1, value_2) -%}
+    {%- set length_1 = "LENGTH(" ~ value_1 ~ ")" -%}
+    {%- set length_2 = "LENGTH(" ~ value_2 ~ ")" -%}
+    {%- set match_window = "GREATEST(FLOOR(GREATEST(" ~ length_1 ~ ", " ~ length_2 ~ ") / 2) - 1, 0)" -%}
+    {%- set prefix_limit = "LEAST(4, " ~ length_1 ~ ", " ~ length_2 ~ ")" -%}
+    CASE
+        WHEN {{ length_1 }} = 0 AND {{ length_2 }} = 0 THEN NULL
+        WHEN {{ length_1 }} = 0 OR {{ length_2 }} = 0 THEN 0.0
+        ELSE AGGREGATE(
+            SEQUENCE(1, {{ length_1 }}),
+            NAMED_STRUCT('used', ARRAY_REPEAT(false, {{ length_2 }}), 'matches', CAST(ARRAY() AS ARRAY<STRING>)),
+            (acc, i) -> TRANSFORM(
+                ARRAY(ARRAY_POSITION(TRANSFORM(SEQUENCE(1, {{ length_2 }}), j -> ABS(i - j) <= {{ match_window }} AND NOT acc.used[j - 1] AND SUBSTRING({{ value_2 }}, j, 1) = SUBSTRING({{ value_1 }}, i, 1)), true)),
+                j -> NAMED_STRUCT(
+                    'used', TRANSFORM(acc.used, (used, k) -> used OR k + 1 = j),
+                    'matches', IF(j > 0, CONCAT(acc.matches, ARRAY(SUBSTRING({{ value_1 }}, i, 1))), acc.matches)
+                )
+            )[0],
+            acc -> CASE
+                WHEN SIZE(acc.matches) = 0 THEN 0.0
+                ELSE TRANSFORM(
+                    ARRAY(FILTER(TRANSFORM(SEQUENCE(1, {{ length_2 }}), j -> IF(acc.used[j - 1], SUBSTRING({{ value_2 }}, j, 1), NULL)), c -> c IS NOT NULL)),
+                    matches_2 -> TRANSFORM(
+                        ARRAY((
+                            SIZE(acc.matches) / {{ length_1 }}
+                            + SIZE(acc.matches) / {{ length_2 }}
+                            + (SIZE(acc.matches) - FLOOR(SIZE(FILTER(SEQUENCE(1, SIZE(acc.matches)), k -> acc.matches[k - 1] <> matches_2[k - 1])) / 2)) / SIZE(acc.matches)
+                        ) / 3),
+                        {# The common-prefix boost only applies above a Jaro similarity of 0.7 #}
+                        jaro -> jaro + IF(jaro > 0.7, 0.1 * (1 - jaro) * COALESCE(
+                            NULLIF(ARRAY_POSITION(TRANSFORM(SEQUENCE(1, {{ prefix_limit }}), k -> SUBSTRING({{ value_1 }}, k, 1) <> SUBSTRING({{ value_2 }}, k, 1)), true), 0) - 1,
+                            {{ prefix_limit }}
+                        ), 0)
+                    )[0]
+                )[0]
+            END
+        ) * 100
+    END
+{%- endmacro %}
+
+{# Token-set (Jaccard) similarity (0-100) of the distinct space-separated tokens of two string expressions #}
+{% macro fuzzy_match_token_set(value_1, value_2) -%}
+    {%- set tokens_1 = "ARRAY_DISTINCT(FILTER(SPLIT(" ~ value_1 ~ ", ' '), token -> token <> ''))" -%}
+    {%- set tokens_2 = "ARRAY_DISTINCT(FILTER(SPLIT(" ~ value_2 ~ ", ' '), token -> token <> ''))" -%}
+    {# SIZE(NULL) is -1 unless ANSI mode is on, so NULL values are excluded explicitly #}
+    CASE WHEN {{ value_1 }} IS NOT NULL AND {{ value_2 }} IS NOT NULL THEN
+        SIZE(ARRAY_INTERSECT({{ tokens_1 }}, {{ tokens_2 }})) / NULLIF(SIZE(ARRAY_UNION({{ tokens_1 }}, {{ tokens_2 }})), 0) * 100
+    END
+{%- endmacro %}
@@ -5,7 +5,7 @@
     loop_expr='value + 1',
     column_name='value',
     max_rows=100000,
-    focus_mode='recursive'
+    focus_mode='auto'
 ) %}
     {% if init_expr is none or init_expr == '' %}
         {% do exceptions.raise_compiler_error("init_expr is required") %}
@@ -48,7 +48,100 @@
         {% set condition_expr_sql = condition_expr %}
     {% endif %}
 
-    {% if relation_name %}
+    {#
+      A constant step with a simple bound is generated in closed form with explode(sequence(...)):
+      numeric 'value + k', date 'date_add(value, k)' / 'date_sub(value, k)' and
+      'value + interval k day|hour|minute|second', bounded by 'value <|<=|>|>= <expr without value>'.
+      sequence() needs start and stop of one type, so init_expr has to be a literal of the step's
+      type (integer, date or timestamp) and the stop is cast to it. focus_mode 'auto' falls back to
+      the recursive CTE otherwise, 'sequence' fails and 'recursive' always recurses. Month steps
+      are left to recursion because repeated add_months drifts away from start + n months.
+    #}
+    {% set re = modules.re %}
+    {% set col_pattern = "(?:`" ~ re.escape(unquoted_col) ~ "`|" ~ re.escape(unquoted_col) ~ ")" %}
+    {% set loop_strip = loop_expr.strip() %}
+    {% set init_is_integer = re.match("^\\d+$", init_strip) %}
+    {% set init_is_date = re.match("^(['\"]?)\\d{4}-\\d{2}-\\d{2}\\1$", init_strip) %}
+    {% set init_is_timestamp = re.match("^(['\"]?)\\d{4}-\\d{2}-\\d{2} \\d{2}:\\d{2}(:\\d{2}(\\.\\d+)?)?\\1$", init_strip) %}
+    {% set step = none %}
+    {% set numeric_step = re.match("^" ~ col_pattern ~ "\\s*([+-])\\s*(\\d+)$", loop_strip)
+        or re.match("^(\\+)?\\s*(\\d+)\\s*\\+\\s*" ~ col_pattern ~ "$", loop_strip) %}
+    {% set date_step = re.match("^date_(add|sub)\\(\\s*" ~ col_pattern ~ "\\s*,\\s*(-?\\d+)\\s*\\)$", loop_strip, re.I) %}
+    {% set interval_step = re.match("^" ~ col_pattern ~ "\\s*([+-])\\s*interval\\s+'?(\\d+)'?\\s+(day|hour|minute|second)s?$", loop_strip, re.I) %}
+    {% if numeric_step and init_is_integer %}
+        {% set step = (numeric_step.group(2) | int) * (-1 if numeric_step.group(1) == '-' else 1) %}
+        {% set start_type = "INT" if (init_strip | int) <= 2147483647 else "BIGINT" %}
+        {% set step_sql = step if start_type == "INT" else "CAST(" ~ step ~ " AS BIGINT)" %}
+        {% set cap_sql = "(" ~ init_select ~ ") + " ~ step * ((max_rows | int) - 1) %}
+    {% elif date_step and init_is_date %}
+        {% set step = (date_step.group(2) | int) * (-1 if date_step.group(1) | lower == 'sub' else 1) %}
+        {% set start_type = "DATE" %}
+        {% set step_sql = "interval " ~ step ~ " day" %}
+        {% set cap_sql = "date_add(" ~ init_select ~ ", " ~ step * ((max_rows | int) - 1) ~ ")" %}
+    {% elif interval_step and (init_is_timestamp or (init_is_date and interval_step.group(3) | lower == 'day')) %}
+        {% set step = (interval_step.group(2) | int) * (-1 if interval_step.group(1) == '-' else 1) %}
+        {% set start_type = "TIMESTAMP" if init_is_timestamp else "DATE" %}
+        {% set step_sql = "interval " ~ step ~ " " ~ interval_step.group(3) | lower %}
+        {% set cap_sql = "(" ~ init_select ~ ") + interval " ~ step * ((max_rows | int) - 1) ~ " " ~ interval_step.group(3) | lower %}
+    {% endif %}
+
+    {% set use_sequence = false %}
+    {% if step is not none and step != 0 and focus_mode != 'recursive'
+        and '<>' not in condition_expr_sql and '!=' not in condition_expr_sql %}
+        {% set condition_strip = condition_expr_sql.strip() %}
+        {% set bound = re.match("^" ~ col_pattern ~ "\\s*(<=|>=|<|>)\\s*(.+)$", condition_strip, re.S) %}
+        {% if bound %}
+            {% set bound_op, bound_expr = bound.group(1), bound.group(2) %}
+        {% else %}
+            {% set bound = re.match("^(.+?)\\s*(<=|>=|<|>)\\s*" ~ col_pattern ~ "$", condition_strip, re.S) %}
+            {% if bound %}
+                {% set bound_op = {'<=': '>=', '<': '>', '>=': '<=', '>': '<'}[bound.group(2)] %}
+                {% set bound_expr = bound.group(1) %}
+            {% endif %}
+        {% endif %}
+        {# The step has to move towards the bound, and the bound must be a single term without the value itself #}
+        {% if bound and (bound_op.startswith('<') == (step > 0))
+            and not re.search("(?<![\\w.])" ~ col_pattern ~ "(?!\\w)", bound_expr)
+            and not re.search("\\b(and|or|not|between|in|is|like|rlike)\\b", bound_expr, re.I) %}
+            {% set use_sequence = true %}
+            {# Clamp the stop so an unreachable bound yields only the (filtered) start and max_rows still caps the series.
+               The clamped stop lies between start and cap, so casting it to the start's type cannot overflow; a
+               truncated fractional stop only adds a value the final filter drops. #}
+            {% set bound_sql = bound_expr if start_type in ["INT", "BIGINT"] else "CAST(" ~ bound_expr ~ " AS " ~ start_type ~ ")" %}
+            {% if step > 0 %}
+                {% set stop_sql = "CAST(least(greatest(" ~ init_select ~ ", " ~ bound_sql ~ "), " ~ cap_sql ~ ") AS " ~ start_type ~ ")" %}
+            {% else %}
+                {% set stop_sql = "CAST(greatest(least(" ~ init_select ~ ", " ~ bound_sql ~ "), " ~ cap_sql ~ ") AS " ~ start_type ~ ")" %}
+            {% endif %}
+            {% set sequence_sql = "explode(sequence(" ~ init_select ~ ", " ~ stop_sql ~ ", " ~ step_sql ~ "))" %}
+        {% endif %}
+    {% endif %}
+    {% if focus_mode == 'sequence' and not use_sequence %}
+        {% do exceptions.raise_compiler_error(
+            "focus_mode 'sequence' needs a literal init_expr, a constant-step loop_expr of the same type and a simple bound in condition_expr") %}
+    {% endif %}
+
+    {% if relation_name and use_sequence %}
+        with gen_input as (
+            select struct({{ alias }}.*) as payload
+            from {{ relation_name }} {{ alias }}
+        ),
+
+        gen as (
+            -- closed-form series: one exploded sequence per input record
+            select payload, {{ sequence_sql }} as {{ internal_col }}
+            from gen_input
+        )
+        select
+            {% if column_name in ['a','b','c','d'] %}
+                payload.* EXCEPT ({{ unquoted_col }}),
+            {% else %}
+                payload.*,
+            {% endif %}
+            {{ internal_col }} as {{ unquoted_col }}
+        from gen
+        where {{ condition_expr_sql | replace(unquoted_col, internal_col) }}
+    {% elif relation_name %}
         with recursive gen as (
             -- base case: one row per input record
             select
@@ -59,13 +152,14 @@
 
             union all
 
-            -- recursive step
+            -- recursive step: only rows still meeting the condition generate a successor
             select
                 gen.payload as payload,
                 {{ loop_expr | replace(unquoted_col, 'gen.' ~ internal_col) }} as {{ internal_col }},
                 _iter + 1
             from gen
             where _iter < {{ max_rows | int }}
+              and {{ condition_expr_sql | replace(unquoted_col, 'gen.' ~ internal_col) }}
         )
         select
             -- ✅ Use safe EXCEPT only if base column might exist; otherwise fallback
@@ -77,6 +171,13 @@
             {{ internal_col }} as {{ unquoted_col }}
         from gen
         where {{ condition_expr_sql | replace(unquoted_col, internal_col) }}
+    {% elif use_sequence %}
+        with gen as (
+            select {{ sequence_sql }} as {{ internal_col }}
+        )
+        select {{ internal_col }} as {{ unquoted_col }}
+        from gen
+        where {{ condition_expr_sql | replace(unquoted_col, internal_col) }}
     {% else %}
         with recursive gen as (
             select {{ init_select }} as {{ internal_col }}, 1 as _iter
@@ -86,6 +187,7 @@
                 _iter + 1
             from gen
             where _iter < {{ max_rows | int }}
+              and {{ condition_expr_sql | replace(unquoted_col, 'gen.' ~ internal_col) }}
         )
         select {{ internal_col }} as {{ unquoted_col }}
         from gen
@@ -7,7 +7,27 @@
     editWith = '',
     customExpression='')
 %}
-    {%- set renamed_columns = [] -%}
+    {# Evaluate every rename expression in one query: each selected column becomes a row of an
+       inline table exposing column_name to the expression #}
+    {%- set evaluated_names = {} -%}
+    {%- if renameMethod == 'advancedRename' and columnNames and execute -%}
+        {%- set column_rows = [] -%}
+        {%- for column in columnNames -%}
+            {%- do column_rows.append("('" ~ column.replace("\\", "\\\\").replace("'", "\\'") ~ "')") -%}
+        {%- endfor -%}
+        {%- set evaluation_query -%}
+            select column_name, ({{ customExpression }}) as result
+            from values {{ column_rows | join(", ") }} as renamed_columns(column_name)
+        {%- endset -%}
+        {%- set evaluation_result = run_query(evaluation_query) -%}
+        {%- if evaluation_result -%}
+            {%- for row in evaluation_result.rows -%}
+                {%- do evaluated_names.update({row[0]: row[1] | string | trim}) -%}
+            {%- endfor -%}
+        {%- endif -%}
+    {%- endif -%}
+
+    {%- set renames_by_column = {} -%}
     {%- for column in columnNames -%}
         {%- set renamed_column = "" -%}
         {%- set quoted_column = DatabricksSqlBasics.quote_identifier(column) -%}
@@ -19,33 +39,24 @@
                     {%- set renamed_column = quoted_column ~ " AS " ~ DatabricksSqlBasics.quote_identifier(column ~ editWith) -%}
                 {%- endif -%}
         {%- elif renameMethod == 'advancedRename' -%}
-                {%- set custom_expr_result = DatabricksSqlBasics.evaluate_expression(customExpression | replace('column_name',  "\'" ~ column ~ "\'"),column) -%}
-                {%- set custom_expr_result_trimmed = custom_expr_result | trim -%}
-                {%- set renamed_column = quoted_column ~ " AS " ~ DatabricksSqlBasics.quote_identifier(custom_expr_result_trimmed) -%}           
+                {# Without a warehouse (compile time) the column keeps its name #}
+                {%- set renamed_column = quoted_column ~ " AS " ~ DatabricksSqlBasics.quote_identifier(evaluated_names.get(column, column)) -%}
         {%- endif -%}
         
-        {%- do renamed_columns.append(renamed_column) -%}
+        {# Key each rename on its unquoted original column so the schema pass is one lookup per column #}
+        {%- set rename_key = DatabricksSqlBasics.unquote_identifier(quoted_column) | trim | upper -%}
+        {%- if rename_key not in renames_by_column -%}
+            {%- do renames_by_column.update({rename_key: renamed_column}) -%}
+        {%- endif -%}
     {%- endfor -%}
 
     {# Get the schema of cleansed data #}
     {%- set output_columns = [] -%}
     {%- for col_name_val in schema -%}
-        {% set flag_dict = {"flag": false} %}
-        {%- for expr in renamed_columns -%}
-            {# Split on 'AS' to get the orig column name; assumes expression contains "AS" #}
-            {%- set parts = expr.split(' AS ') -%}
-            {%- set orig_col_name = parts[0] | trim -%}
-            {%- set unquoted_orig_col = DatabricksSqlBasics.unquote_identifier(orig_col_name) | upper -%}
-            {%- set unquoted_schema_col = DatabricksSqlBasics.unquote_identifier(col_name_val) | upper -%}
-            
-            {%- if unquoted_schema_col == unquoted_orig_col -%}
-                {%- do output_columns.append(expr) -%}
-                {% do flag_dict.update({"flag": true}) %}
-                {%- break -%}
-            {%- endif -%}
-        {%- endfor -%}
-
-        {%- if flag_dict.flag == false -%}    
+        {%- set unquoted_schema_col = DatabricksSqlBasics.unquote_identifier(col_name_val) | trim | upper -%}
+        {%- if unquoted_schema_col in renames_by_column -%}
+            {%- do output_columns.append(renames_by_column[unquoted_schema_col]) -%}
+        {%- else -%}
             {%- do output_columns.append(DatabricksSqlBasics.quote_identifier(col_name_val)) -%}
         {%- endif -%}
     {%- endfor -%}
@@ -0,0 +1,51 @@
+"""
+Compile-time benchmark of the MultiColumnRename macro on wide schemas.
+
+Renders the macro with jinja2 for generated schemas of several thousand columns, renaming
+every other column, and reports the median render time per schema width. With --max-seconds
+it exits non-zero when the widest schema renders slower than that. Needs jinja2:
+
+    python scripts/benchmark_multi_column_rename.py --columns 1000 5000 --max-seconds 2
+"""
+import argparse
+import statistics
+import sys
+import time
+
+from macro_renderer import load_macros
+
+
+def render_seconds(macros, column_count, repeats):
+    schema = [f"column_{index:05d}" for index in range(column_count)]
+    renamed = schema[::2]
+    timings = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        sql = str(macros.MultiColumnRename("wide_table", renamed, "editPrefixSuffix", schema, "Prefix", "renamed_"))
+        timings.append(time.perf_counter() - started)
+    # Every column is selected once, and every renamed column under its new name
+    if sql.count("renamed_column_") != len(renamed) or sql.count("`column_") != column_count:
+        raise AssertionError(f"unexpected MultiColumnRename output for {column_count} columns")
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--columns", type=int, nargs="+", default=[500, 1000, 5000])
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--max-seconds", type=float, default=0)
+    args = parser.parse_args()
+
+    macros = load_macros("identifier_helpers.sql", "MultiColumnRename.sql")
+    seconds = 0.0
+    for column_count in sorted(args.columns):
+        seconds = render_seconds(macros, column_count, args.repeats)
+        print(f"{column_count:>7} columns  {seconds:8.3f} s")
+    if args.max_seconds and seconds > args.max_seconds:
+        print(f"the widest schema took {seconds:.3f} s, above {args.max_seconds} s")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
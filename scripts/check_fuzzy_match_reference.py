@@ -0,0 +1,94 @@
+"""
+Checks fuzzy_match_reference.py against the SQL rendered from macros/FuzzyMatch.sql.
+
+Renders the macro for a few configurations, runs each query on a local Spark session over a
+sample table and compares the matched pairs and similarity scores with the reference
+implementation. Needs jinja2, pyspark and NumPy:
+
+    python scripts/check_fuzzy_match_reference.py
+"""
+import math
+import sys
+
+from pyspark.sql import SparkSession
+
+from fuzzy_match_reference import fuzzy_match
+from macro_renderer import load_macros
+
+SAMPLE_COLUMNS = ["id", "source", "first_name", "last_name", "address", "phone"]
+SAMPLE_RECORDS = [
+    (1, "crm", "Jonathan", "Smith", "12 High Street", "555-0101"),
+    (2, "crm", "Jon", "Smith", "12 High St.", "5550101"),
+    (3, "web", "Johnathan", "Smyth", "12 High Street, Flat 2", "555 0101"),
+    (4, "web", "Maria", "Garcia", "4 Elm Road", "555-0199"),
+    (5, "crm", "María", "Garcia-Lopez", "4 Elm Rd", None),
+    (6, "web", "Mary", "Garsia", None, "555-0199"),
+    (7, "crm", "Wei", "Zhang", "88 Harbour View", "555-0142"),
+    (8, "web", "Zhang", "Wei", "88 Harbor View", "555-0142"),
+    (9, "crm", None, "Smith", "12 High Street", None),
+    (10, "web", "Li", "Zhang", "88 Harbour View Apt 1", "555-0143"),
+]
+
+# FuzzyMatch macro arguments of each checked configuration
+CASES = {
+    "purge, all pairs": dict(
+        mode="PURGE", sourceIdCol="", matchFields={"name": ["first_name"], "custom": ["address"]},
+        matchThresholdPercentage=60, includeSimilarityScore=True),
+    "purge, blocked and weighted": dict(
+        mode="PURGE", sourceIdCol="", matchFields={"name": ["first_name"], "token_set": ["address"], "phone": ["phone"]},
+        matchThresholdPercentage=50, includeSimilarityScore=True,
+        blockingKeys=[{"columnName": "last_name", "method": "soundex"}, {"columnName": "phone", "method": "digits"}],
+        matchFieldWeights={"first_name": 2, "address": 1, "phone": 0.5}),
+    "merge, exact and phonetic": dict(
+        mode="MERGE", sourceIdCol="source", matchFields={"phonetic": ["last_name"], "exact": ["phone"], "address": ["address"]},
+        matchThresholdPercentage=40, includeSimilarityScore=False),
+}
+
+
+def render_fuzzy_match(relation, arguments):
+    macros = load_macros("identifier_helpers.sql", "FuzzyMatch.sql")
+    return str(macros.FuzzyMatch(relation, recordIdCol="id", **arguments))
+
+
+def reference_pairs(arguments):
+    columns = {name: [record[k] for record in SAMPLE_RECORDS] for k, name in enumerate(SAMPLE_COLUMNS)}
+    result = fuzzy_match(
+        columns, arguments["mode"], arguments["sourceIdCol"], "id", arguments["matchFields"],
+        arguments.get("matchThresholdPercentage", 0), arguments.get("includeSimilarityScore", False),
+        arguments.get("blockingKeys", []), arguments.get("matchFieldWeights"))
+    scores = result.get("similarity_score", [None] * len(result["record_id1"]))
+    return sorted(zip(result["record_id1"], result["record_id2"], scores))
+
+
+def sql_pairs(spark, arguments):
+    rows = spark.sql(render_fuzzy_match("sample_records", arguments)).collect()
+    return sorted((row["record_id1"], row["record_id2"], row["similarity_score"] if "similarity_score" in row else None)
+                  for row in rows)
+
+
+def _same(pairs_1, pairs_2):
+    return len(pairs_1) == len(pairs_2) and all(
+        a[:2] == b[:2] and (a[2] is None) == (b[2] is None) and (a[2] is None or math.isclose(a[2], b[2], abs_tol=1e-9))
+        for a, b in zip(pairs_1, pairs_2))
+
+
+def main():
+    spark = SparkSession.builder.master("local[1]").appName("check_fuzzy_match_reference").getOrCreate()
+    spark.createDataFrame(
+        SAMPLE_RECORDS, "id int, source string, first_name string, last_name string, address string, phone string"
+    ).createOrReplaceTempView("sample_records")
+    failures = 0
+    for name, arguments in CASES.items():
+        expected = reference_pairs(arguments)
+        actual = sql_pairs(spark, arguments)
+        if _same(expected, actual):
+            print(f"ok       {name}: {len(actual)} pairs")
+        else:
+            failures += 1
+            print(f"MISMATCH {name}\n  reference: {expected}\n  sql:       {actual}")
+    spark.stop()
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,358 @@
+"""
+Local reference implementation of the FuzzyMatch macro.
+
+Scores record pairs with the same normalizations, match functions, weighted averaging,
+rounding, thresholding and PURGE/MERGE semantics as macros/FuzzyMatch.sql, on columns held
+in memory (NumPy arrays, Python lists or a pyarrow Table). It is meant for verifying the
+SQL output, benchmarking candidate generation offline and scoring small extracts without a
+warehouse round-trip; it is not used by the gems.
+
+    result = fuzzy_match(table, "PURGE", "", "id", {"name": ["first_name"]}, 80,
+                         include_similarity_score=True,
+                         blocking_keys=[{"columnName": "last_name", "method": "soundex"}])
+"""
+from __future__ import annotations
+
+import string
+from decimal import Decimal, ROUND_HALF_UP
+from typing import Dict, List, Mapping, Optional, Sequence, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # the gems are loaded without NumPy; only this module needs it
+    np = None
+
+# Match function used for each matchFields key; unknown keys fall back to Levenshtein.
+MATCH_FUNCTIONS = {
+    "custom": "LEVENSHTEIN",
+    "name": "JARO_WINKLER",
+    "phonetic": "EQUALS",
+    "token_set": "TOKEN_SET",
+    "phone": "EQUALS",
+    "address": "LEVENSHTEIN",
+    "exact": "EXACT",
+    "equals": "EQUALS",
+}
+
+# Java regular expressions have no POSIX bracket classes: '[[:punct:]]' is the set of ':' and
+# lowercase p, u, n, c and t. \p{Punct} is ASCII punctuation and \s the ASCII whitespace.
+_BRACKET_PUNCT_TABLE = str.maketrans("", "", ":punct")
+_PUNCTUATION_TABLE = str.maketrans("", "", string.punctuation)
+_SPACE_CHARACTERS = " \t\n\x0b\f\r"
+
+# Spark's soundex codes for A-Z; 7 marks H and W, which do not separate equal codes
+_SOUNDEX_CODES = "01230127022455012623017202"
+
+
+def _require_numpy():
+    if np is None:
+        raise ImportError("fuzzy_match_reference needs NumPy: pip install numpy")
+
+
+def _to_pylist(values) -> list:
+    if hasattr(values, "to_pylist"):
+        return values.to_pylist()
+    if hasattr(values, "tolist"):
+        return values.tolist()
+    return list(values)
+
+
+def _columns(data) -> Dict[str, list]:
+    if hasattr(data, "to_pydict"):
+        return data.to_pydict()
+    return {name: _to_pylist(values) for name, values in data.items()}
+
+
+def cast_string(value) -> Optional[str]:
+    """CAST(value AS STRING) for the scalar types found in match columns."""
+    if hasattr(value, "item") and not isinstance(value, (str, bytes)):
+        value = value.item()
+    if value is None or (isinstance(value, float) and value != value):
+        return None
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return str(value)
+
+
+def strip_bracket_punct(value: Optional[str]) -> Optional[str]:
+    """UPPER(REGEXP_REPLACE(value, '[[:punct:]]', '')), the custom, name and address normalization"""
+    return None if value is None else value.translate(_BRACKET_PUNCT_TABLE).upper()
+
+
+def strip_punctuation(value: Optional[str]) -> Optional[str]:
+    """UPPER(REGEXP_REPLACE(value, '\\\\p{Punct}', ''))"""
+    return None if value is None else value.translate(_PUNCTUATION_TABLE).upper()
+
+
+def soundex(value: Optional[str]) -> Optional[str]:
+    """Spark's SOUNDEX: values that do not start with a letter are returned unchanged."""
+    if value is None or value == "":
+        return value
+    first = value[0].upper()
+    if not ("A" <= first <= "Z"):
+        return value
+    code = [first]
+    last_code = _SOUNDEX_CODES[ord(first) - ord("A")]
+    for character in value[1:]:
+        character = character.upper()
+        if not ("A" <= character <= "Z"):
+            continue
+        character_code = _SOUNDEX_CODES[ord(character) - ord("A")]
+        if character_code == "7":
+            continue
+        if character_code != "0" and character_code != last_code:
+            code.append(character_code)
+            if len(code) > 3:
+                break
+        last_code = character_code
+    return "".join(code).ljust(4, "0")
+
+
+def normalize_values(values: Sequence, key: str) -> List[Optional[str]]:
+    """Normalized match value of each row for a matchFields key."""
+    strings = [cast_string(value) for value in values]
+    if key in ("custom", "name", "address"):
+        return [strip_bracket_punct(value) for value in strings]
+    if key == "phonetic":
+        normalized = [soundex(_trim(strip_punctuation(value))) for value in strings]
+        return [value if value else None for value in normalized]
+    if key == "token_set":
+        return [None if value is None else _trim(" ".join(_split_space(strip_punctuation(value))))
+                for value in strings]
+    return strings
+
+
+def _trim(value: Optional[str]) -> Optional[str]:
+    return None if value is None else value.strip(" ")
+
+
+def _split_space(value: str) -> List[str]:
+    # REGEXP_REPLACE(value, '\\\\s+', ' ') keeps leading and trailing runs as one space
+    tokens, current, in_space = [], [], False
+    for character in value:
+        if character in _SPACE_CHARACTERS:
+            if not in_space:
+                tokens.append("".join(current))
+                current, in_space = [], True
+        else:
+            current.append(character)
+            in_space = False
+    tokens.append("".join(current))
+    return tokens
+
+
+def levenshtein_distances(values_1: Sequence[str], values_2: Sequence[str], batch_size: int = 4096) -> np.ndarray:
+    """
+    Levenshtein distance of each pair (values_1[i], values_2[i]).
+
+    Pairs are sorted by length and processed in batches; the dynamic programme runs once per
+    batch with NumPy operations over all pairs of the batch at the same time.
+    """
+    _require_numpy()
+    pair_count = len(values_1)
+    distances = np.zeros(pair_count, dtype=np.int64)
+    lengths_1 = np.fromiter((len(value) for value in values_1), dtype=np.int64, count=pair_count)
+    lengths_2 = np.fromiter((len(value) for value in values_2), dtype=np.int64, count=pair_count)
+    order = np.argsort(np.maximum(lengths_1, lengths_2), kind="stable")
+    for start in range(0, pair_count, batch_size):
+        batch = order[start:start + batch_size]
+        batch_lengths_1 = lengths_1[batch]
+        batch_lengths_2 = lengths_2[batch]
+        max_length_1 = int(batch_lengths_1.max())
+        max_length_2 = int(batch_lengths_2.max())
+        codes_1 = np.full((len(batch), max_length_1), -1, dtype=np.int64)
+        codes_2 = np.full((len(batch), max_length_2), -2, dtype=np.int64)
+        for row, pair in enumerate(batch):
+            codes_1[row, :lengths_1[pair]] = [ord(character) for character in values_1[pair]]
+            codes_2[row, :lengths_2[pair]] = [ord(character) for character in values_2[pair]]
+
+        previous = np.tile(np.arange(max_length_2 + 1, dtype=np.int64), (len(batch), 1))
+        result = previous[np.arange(len(batch)), batch_lengths_2].copy()
+        for i in range(1, max_length_1 + 1):
+            current = np.empty_like(previous)
+            current[:, 0] = i
+            substitution = previous[:, :-1] + (codes_1[:, i - 1:i] != codes_2)
+            deletion = previous[:, 1:] + 1
+            best = np.minimum(substitution, deletion)
+            for j in range(1, max_length_2 + 1):
+                current[:, j] = np.minimum(best[:, j - 1], current[:, j - 1] + 1)
+            finished = batch_lengths_1 == i
+            result[finished] = current[finished, batch_lengths_2[finished]]
+            previous = current
+        distances[batch] = result
+    return distances
+
+
+def jaro_winkler_similarity(value_1: str, value_2: str) -> Optional[float]:
+    """Jaro-Winkler similarity (0-100), as fuzzy_match_jaro_winkler computes it."""
+    length_1, length_2 = len(value_1), len(value_2)
+    if length_1 == 0 and length_2 == 0:
+        return None
+    if length_1 == 0 or length_2 == 0:
+        return 0.0
+    window = max(max(length_1, length_2) // 2 - 1, 0)
+    used = [False] * length_2
+    matches_1 = []
+    for i, character in enumerate(value_1):
+        for j in range(max(0, i - window), min(length_2, i + window + 1)):
+            if not used[j] and value_2[j] == character:
+                used[j] = True
+                matches_1.append(character)
+                break
+    match_count = len(matches_1)
+    if match_count == 0:
+        return 0.0
+    matches_2 = [value_2[j] for j in range(length_2) if used[j]]
+    transpositions = sum(1 for a, b in zip(matches_1, matches_2) if a != b) // 2
+    jaro = (match_count / length_1 + match_count / length_2 + (match_count - transpositions) / match_count) / 3
+    if jaro > 0.7:
+        prefix = 0
+        for a, b in zip(value_1[:4], value_2[:4]):
+            if a != b:
+                break
+            prefix += 1
+        jaro += 0.1 * (1 - jaro) * prefix
+    return jaro * 100
+
+
+def token_set_similarity(value_1: str, value_2: str) -> Optional[float]:
+    """Jaccard similarity (0-100) of the distinct space-separated tokens."""
+    tokens_1 = {token for token in value_1.split(" ") if token}
+    tokens_2 = {token for token in value_2.split(" ") if token}
+    union = tokens_1 | tokens_2
+    if not union:
+        return None
+    return len(tokens_1 & tokens_2) / len(union) * 100
+
+
+def field_scores(function: str, values: List[Optional[str]], index_1: np.ndarray, index_2: np.ndarray) -> List[Optional[float]]:
+    """Score of one match field for every candidate pair; None where the SQL score is NULL."""
+    scores: List[Optional[float]] = [None] * len(index_1)
+    present = [k for k, (i, j) in enumerate(zip(index_1, index_2))
+               if values[i] is not None and values[j] is not None]
+    if function == "LEVENSHTEIN":
+        distances = levenshtein_distances([values[index_1[k]] for k in present],
+                                          [values[index_2[k]] for k in present])
+        for k, distance in zip(present, distances):
+            longest = max(len(values[index_1[k]]), len(values[index_2[k]]))
+            scores[k] = None if longest == 0 else (1 - int(distance) / longest) * 100
+        return scores
+    for k in present:
+        value_1, value_2 = values[index_1[k]], values[index_2[k]]
+        if function == "EXACT":
+            scores[k] = 100.0 if value_1 == value_2[::-1] else 0.0
+        elif function == "EQUALS":
+            scores[k] = 100.0 if value_1 == value_2 else 0.0
+        elif function == "JARO_WINKLER":
+            scores[k] = jaro_winkler_similarity(value_1, value_2)
+        elif function == "TOKEN_SET":
+            scores[k] = token_set_similarity(value_1, value_2)
+    return scores
+
+
+def block_values(values: Sequence, method: str = "prefix", length: int = 0) -> List[Optional[str]]:
+    """Block value of each row for a blocking key, as in the blocking_keys CTE."""
+    strings = [cast_string(value) for value in values]
+    if method == "digits":
+        derived = [None if value is None else "".join(c for c in value if "0" <= c <= "9") for value in strings]
+    else:
+        normalized = [_trim(strip_punctuation(value)) for value in strings]
+        if method == "soundex":
+            derived = [soundex(value) for value in normalized]
+        elif method == "first_token":
+            derived = [None if value is None else value.split(" ", 1)[0] for value in normalized]
+        else:
+            derived = normalized
+            if method != "exact" and length <= 0:
+                length = 3
+    if length > 0 and method not in ("soundex", "first_token", "exact"):
+        derived = [None if value is None else value[:length] for value in derived]
+    return derived
+
+
+def candidate_pairs(record_ids: Sequence[str], block_columns: Sequence[Sequence[Optional[str]]] = (),
+                    source_ids: Optional[Sequence[str]] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Row indexes (i, j) of the pairs to compare, with record_ids[i] > record_ids[j].
+
+    Without block columns all pairs are returned; otherwise pairs sharing a value in at least
+    one block column. With source_ids only pairs from different sources are kept.
+    """
+    _require_numpy()
+    ids = np.asarray(record_ids, dtype=object)
+    if len(block_columns) == 0:
+        index_1, index_2 = np.nonzero(ids[:, None] > ids[None, :])
+    else:
+        pairs = set()
+        for block_column in block_columns:
+            blocks: Dict[str, List[int]] = {}
+            for row, value in enumerate(block_column):
+                if value is not None and value != "":
+                    blocks.setdefault(value, []).append(row)
+            for rows in blocks.values():
+                for a in rows:
+                    for b in rows:
+                        if ids[a] > ids[b]:
+                            pairs.add((a, b))
+        ordered = sorted(pairs)
+        index_1 = np.fromiter((a for a, _ in ordered), dtype=np.int64, count=len(ordered))
+        index_2 = np.fromiter((b for _, b in ordered), dtype=np.int64, count=len(ordered))
+    if source_ids is not None:
+        sources = np.asarray(source_ids, dtype=object)
+        different = sources[index_1] != sources[index_2]
+        index_1, index_2 = index_1[different], index_2[different]
+    return index_1, index_2
+
+
+def _round_half_up(value: float) -> float:
+    # round(x, 2) on a double, which rounds the shortest decimal representation half up
+    return float(Decimal(repr(float(value))).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP))
+
+
+def fuzzy_match(data, mode: str, source_id_col: str, record_id_col: str, match_fields: Mapping[str, Sequence[str]],
+                match_threshold_percentage: float = 0, include_similarity_score: bool = False,
+                blocking_keys: Sequence[Mapping] = (), match_field_weights: Optional[Mapping[str, float]] = None
+                ) -> Dict[str, list]:
+    """
+    Matched record pairs, with the arguments of the FuzzyMatch macro.
+
+    Returns the columns record_id1 and record_id2 (and similarity_score when requested) of the
+    pairs whose weighted average score, rounded to 2 decimals, reaches the threshold. In any
+    other mode than PURGE or MERGE the input columns are returned unchanged, as the macro does.
+    """
+    _require_numpy()
+    columns = _columns(data)
+    if mode not in ("PURGE", "MERGE"):
+        return columns
+    weights = match_field_weights or {}
+    record_ids = [cast_string(value) for value in columns[record_id_col]]
+    source_ids = [cast_string(value) for value in columns[source_id_col]] if mode == "MERGE" else None
+    block_columns = [block_values(columns[key["columnName"]], key.get("method", "prefix"), int(key.get("length", 0) or 0))
+                     for key in blocking_keys]
+    index_1, index_2 = candidate_pairs(record_ids, block_columns, source_ids)
+
+    weighted_sums = np.zeros(len(index_1))
+    scored_weights = np.zeros(len(index_1))
+    for key, field_columns in match_fields.items():
+        function = MATCH_FUNCTIONS.get(key, "LEVENSHTEIN")
+        for column in field_columns:
+            weight = float(weights.get(column, 1))
+            scores = field_scores(function, normalize_values(columns[column], key), index_1, index_2)
+            for k, score in enumerate(scores):
+                if score is not None:
+                    weighted_sums[k] += score * weight
+                    scored_weights[k] += weight
+
+    result: Dict[str, list] = {"record_id1": [], "record_id2": []}
+    if include_similarity_score:
+        result["similarity_score"] = []
+    for k in range(len(index_1)):
+        if scored_weights[k] == 0:
+            continue
+        similarity_score = _round_half_up(weighted_sums[k] / scored_weights[k])
+        if similarity_score >= match_threshold_percentage:
+            result["record_id1"].append(record_ids[index_1[k]])
+            result["record_id2"].append(record_ids[index_2[k]])
+            if include_similarity_score:
+                result["similarity_score"].append(similarity_score)
+    return result
@@ -0,0 +1,72 @@
+"""
+Renders the package macros with jinja2 outside dbt, for the scripts in this directory.
+
+Only the parts of the dbt context the rendered macros use are provided: the
+DatabricksSqlBasics namespace, execute, log, exceptions, config, is_incremental, this,
+local_md5 and return. run_query returns None, as it does while dbt parses a project.
+"""
+import hashlib
+import os
+
+import jinja2
+
+MACRO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "macros")
+
+
+class _Return(Exception):
+    def __init__(self, value):
+        self.value = value
+
+
+def _return(value):
+    raise _Return(value)
+
+
+class _Exceptions:
+    @staticmethod
+    def raise_compiler_error(message):
+        raise RuntimeError(message)
+
+
+class _Config:
+    @staticmethod
+    def get(key, default=None):
+        return default
+
+
+class _Macros:
+    """The DatabricksSqlBasics namespace; a macro that calls return() yields the returned value."""
+
+    def __init__(self):
+        self.module = None
+
+    def __getattr__(self, name):
+        macro = getattr(self.module, name)
+
+        def call(*args, **kwargs):
+            try:
+                return macro(*args, **kwargs)
+            except _Return as returned:
+                return returned.value
+        return call
+
+
+def load_macros(*file_names, execute=True):
+    """Namespace of the macros defined in the given files of macros/."""
+    macros = _Macros()
+    context = {
+        "DatabricksSqlBasics": macros,
+        "execute": execute,
+        "run_query": lambda sql: None,
+        "log": lambda message, info=False: "",
+        "exceptions": _Exceptions,
+        "config": _Config,
+        "is_incremental": lambda: False,
+        "this": "this",
+        "local_md5": lambda value: hashlib.md5(value.encode("utf-8")).hexdigest(),
+        "return": _return,
+    }
+    environment = jinja2.Environment(extensions=["jinja2.ext.do", "jinja2.ext.loopcontrols"])
+    source = "\n".join(open(os.path.join(MACRO_DIR, name)).read() for name in file_names)
+    macros.module = environment.from_string(source, globals=context).make_module(vars=context)
+    return macros